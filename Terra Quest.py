@@ -21,7 +21,83 @@ The user has the option to reset all game data to deafult starting values.
 
 """
 
+import os
+import sys
+import argparse
+import subprocess
+import struct
+import gc
+import tracemalloc
+import zlib
+import mmap
+import weakref
+import sqlite3
+import tempfile
+import threading
+import queue
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from math import lcm
+from datetime import datetime
 from random import *
+
+# Command line options. Running the game normally doesn't need any of these,
+# they're for replaying seeds and for letting a bot play the game for hours to test it.
+
+SEED_RANGE = 2**32 # seeds are saved (ghost recordings) and sent (ghost race) as unsigned 32 bit numbers
+
+
+def seed_number(text):
+    """
+    --seed takes any whole number, and wraps it around into 0 to SEED_RANGE-1 so it fits everywhere it's saved.
+    (New seeds are picked in that range too, with getrandbits(32).)
+    """
+    return int(text) % SEED_RANGE
+
+
+parser = argparse.ArgumentParser(description="Terra Quest")
+parser.add_argument("--seed", type=seed_number, help="seed for the levels of the run (the same seed gives the same levels)")
+parser.add_argument("--bot", action="store_true", help="let the bot play instead of the keyboard")
+parser.add_argument("--headless", action="store_true", help="run without a window or sound, as fast as possible")
+parser.add_argument("--bot-minutes", type=float, default=0, help="how long the bot plays for (0 = until closed)")
+parser.add_argument("--bot-processes", type=int, default=1, help="run this many bots at once, each with its own seed")
+parser.add_argument("--terrain", default="forest", help="terrain the bot plays in")
+parser.add_argument("--character", type=int, default=0, help="character the bot plays as")
+parser.add_argument("--leaderboard", action="store_true", help="print the best runs and the stats of every terrain, then exit")
+parser.add_argument("--ghost-server", action="store_true", help="run the server for ghost races (see --ghosts)")
+parser.add_argument("--ghosts", action="store_true", help="race the other players connected to the ghost server")
+parser.add_argument("--ghost-port", type=int, default=47000, help="port of the ghost server")
+parser.add_argument("--ghost-record", help="record the run to this file, to race against later")
+parser.add_argument("--ghost-replay", help="race against a run recorded with --ghost-record")
+parser.add_argument("--scale", type=int, default=1, help="make the window this many times bigger")
+parser.add_argument("--fullscreen", action="store_true", help="fill the whole screen")
+parser.add_argument("--scaling", choices=["integer", "sdl"], default="integer",
+                    help="integer: the game scales its own image by whole numbers, sdl: SDL's SCALED mode does it")
+parser.add_argument("--renderer", choices=["software", "texture", "texture-software"], default="software",
+                    help="software: pygame draws everything itself, texture: the graphics card draws the game with SDL textures, "
+                         "texture-software: the same textures but drawn by SDL's software renderer (for computers without a graphics card)")
+parser.add_argument("--stretch", action="store_true", help="stretch the image to fill the window instead of adding black bars")
+parser.add_argument("--memory-trace", action="store_true", help="write a memory report at every chunk and screen change")
+parser.add_argument("--telemetry", action="store_true", help="record gameplay events (pickups, spike hits...) to DATA/logs/telemetry")
+parser.add_argument("--check-landings", action="store_true", help="drop the player from every height and check they land, then exit")
+parser.add_argument("--memory-frames", type=int, default=1, help="how many stack frames to remember per allocation in the memory report")
+parser.add_argument("--bot-number", type=int, help="set by --bot-processes for each of its bots, so their log files don't clash")
+args = parser.parse_args()
+
+LOG_SUFFIX = "" # added to the names of the log files (memory report, telemetry, generation timings)
+if args.bot_number is not None:
+    LOG_SUFFIX = f"_{args.bot_number}"
+
+no_game = args.ghost_server or args.leaderboard or args.check_landings # these exit without ever showing the game
+
+if args.headless or no_game: # SDL's "dummy" drivers don't open a window or play sound (they have to be set before init())
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+if no_game: # SDL turns Ctrl+C and kill into a QUIT event for the game's window, which nothing would read, so leave them to Python
+    os.environ["SDL_NO_SIGNAL_HANDLERS"] = "1"
+
 from pygame import *
 
 init()
@@ -31,14 +107,169 @@ BACKGROUND_SIZE = 24 # length of background tiles
 
 FIT = (TILE_SIZE * BACKGROUND_SIZE) # 18 x 24 so that all my tiles will fit perfectly on the screen with no remainders.
 WIDTH, HEIGHT = FIT*2, FIT
-screen = display.set_mode((WIDTH, HEIGHT))
 display.set_caption("Terra Quest")
 
+# Everything in the game is drawn onto "screen", which is always WIDTH x HEIGHT.
+# If the window is bigger than that (--scale or --fullscreen), screen is an off-screen surface,
+# and present() scales the whole thing onto the window in one go, once per frame
+# (instead of every tile having to be scaled up). Nearest-neighbour scaling by a whole number keeps the pixel art sharp,
+# and whatever is left over around the edges of the window is black bars.
+#
+# With --renderer texture the game itself isn't drawn onto screen at all. Every image is uploaded to the graphics card
+# once (as an SDL texture) and each frame is drawn from those textures, see draw_image().
+# The menus still draw onto screen like normal, and present() uploads screen as one texture when they do.
+render = {"mode": "direct", # direct: screen is the window. integer: present() scales screen. sdl: SDL scales it. texture: see above
+          "window": None,
+          "area": Rect(0, 0, WIDTH, HEIGHT), # where on the window the game's image goes
+          "scale": 1,
+          "renderer": None, # the SDL renderer, only for the texture mode
+          "textures": weakref.WeakKeyDictionary(), # image:its texture. When an image isn't used anymore, its texture goes too.
+          "screen_texture": None, # screen gets copied into this when the menus are showing
+          "textured_frame": False} # True once draw_image() has drawn with textures this frame
+
+if args.renderer != "software":
+    from pygame._sdl2.video import Window, Renderer, Texture # pygame's (experimental) wrapper for SDL's 2D renderer
+    render["window"] = Window("Terra Quest", size=(WIDTH * args.scale, HEIGHT * args.scale), fullscreen_desktop=args.fullscreen)
+    # accelerated=0 asks for SDL's software renderer, -1 lets SDL pick (the graphics card if there is one)
+    render["renderer"] = Renderer(render["window"], accelerated=0 if args.renderer == "texture-software" else -1)
+    if args.stretch:
+        window_width, window_height = render["window"].size
+        render["renderer"].scale = (window_width / WIDTH, window_height / HEIGHT)
+    else:
+        render["renderer"].logical_size = (WIDTH, HEIGHT) # SDL scales the frame to fit the window and adds the black bars
+    # SDL also changes mouse positions to match the logical size, so get_events() doesn't have to.
+    screen = Surface((WIDTH, HEIGHT))
+    render["screen_texture"] = Texture(render["renderer"], (WIDTH, HEIGHT), streaming=True)
+    render["mode"] = "texture"
+elif args.scaling == "sdl":
+    screen = display.set_mode((WIDTH, HEIGHT), SCALED | (FULLSCREEN if args.fullscreen else 0))
+    render["mode"] = "sdl"
+elif args.scale > 1 or args.fullscreen:
+    if args.fullscreen:
+        render["window"] = display.set_mode((0, 0), FULLSCREEN)
+    else:
+        render["window"] = display.set_mode((WIDTH * args.scale, HEIGHT * args.scale))
+    screen = Surface((WIDTH, HEIGHT)).convert()
+    render["mode"] = "integer"
+
+    window_width, window_height = render["window"].get_size()
+    if args.stretch:
+        render["area"] = Rect(0, 0, window_width, window_height)
+    else:
+        render["scale"] = max(1, min(window_width // WIDTH, window_height // HEIGHT))
+        render["area"] = Rect(0, 0, WIDTH * render["scale"], HEIGHT * render["scale"])
+        render["area"].center = (window_width // 2, window_height // 2)
+    render["window"].fill(0) # black bars
+else:
+    screen = display.set_mode((WIDTH, HEIGHT))
+
+
+def present():
+    """
+    Shows what has been drawn onto screen. Used instead of display.flip().
+    """
+    if render["mode"] == "texture":
+        if not render["textured_frame"]: # a menu drew this frame onto screen
+            render["screen_texture"].update(screen)
+            render["renderer"].draw_color = (0, 0, 0, 255)
+            render["renderer"].clear()
+            render["screen_texture"].draw()
+        render["renderer"].present()
+        render["textured_frame"] = False
+        return
+    if render["mode"] == "integer":
+        if render["area"].size == screen.get_size():
+            render["window"].blit(screen, render["area"])
+        else:
+            transform.scale(screen, render["area"].size, render["window"].subsurface(render["area"]))
+    display.flip()
+
+
+def draw_image(image, position, area=None):
+    """
+    Everything in the game (not the menus) is drawn with this, so it can be drawn with either backend.
+    area is the part of image to draw, like in Surface.blit().
+    """
+    if render["mode"] != "texture":
+        screen.blit(image, position, area)
+        return
+
+    renderer = render["renderer"]
+    if not render["textured_frame"]: # first thing drawn this frame
+        renderer.draw_color = (0, 0, 0, 255)
+        renderer.clear()
+        render["textured_frame"] = True
+
+    texture = render["textures"].get(image)
+    if texture is None: # first time this image is drawn, so upload it
+        texture = Texture.from_surface(renderer, image)
+        render["textures"][image] = texture
+
+    if area is None:
+        texture.draw(dstrect=position)
+    else:
+        area = Rect(area)
+        texture.draw(srcrect=area, dstrect=(position[0], position[1], area.width, area.height))
+
+
+def image_changed(image, area):
+    """
+    Call after drawing onto an image that draw_image() has already drawn,
+    so the texture renderer's copy of that area gets updated too.
+    """
+    texture = render["textures"].get(image)
+    if texture is not None:
+        texture.update(image.subsurface(area), area)
+
+
+def draw_images(blits):
+    """
+    Draws a list of (image, position, area) all at once, like Surface.blits().
+    """
+    if render["mode"] != "texture":
+        screen.blits(blits, doreturn=False)
+        return
+    for image, position, area in blits:
+        draw_image(image, position, area)
+
+
+def fill_screen(colour):
+    """
+    Fills the whole screen with one colour, with either backend.
+    """
+    if render["mode"] != "texture":
+        screen.fill(colour)
+        return
+    render["renderer"].draw_color = colour
+    render["renderer"].clear()
+    render["textured_frame"] = True
+
+
+def get_events():
+    """
+    Used instead of event.get(). When present() scales the image, the mouse position
+    gets scaled back so it matches what was drawn on screen.
+    """
+    events = event.get()
+    if render["mode"] != "integer":
+        return events
+
+    area = render["area"]
+    for i in range(len(events)):
+        if hasattr(events[i], "pos"):
+            x = (events[i].pos[0] - area.x) * WIDTH // area.width
+            y = (events[i].pos[1] - area.y) * HEIGHT // area.height
+            events[i] = event.Event(events[i].type, dict(events[i].dict, pos=(x, y)))
+    return events
+
+
 LEVEL_WIDTH = 400  # number of tile colums in a "level chunk" when scrolling.
 # Since this is an endless scroller, once the player reaches the end of the level chunk,
 # 400 more tile columns worth of game is generated.
 
-LEVEL_HEIGHT = HEIGHT // TILE_SIZE # the number of tiles tall the screen is.
+SCREEN_ROWS = HEIGHT // TILE_SIZE # the number of tiles tall the screen is.
+LEVEL_SCREENS_TALL = 2 # levels are taller than the screen (see pass_climbs()), and the camera scrolls up and down to follow the player.
+LEVEL_HEIGHT = SCREEN_ROWS * LEVEL_SCREENS_TALL # the number of tile rows in a level chunk.
 
 coin_sound = mixer.Sound("DATA/music/coin.mp3") # collecting coins sound
 gem_sound = mixer.Sound("DATA/music/gem.mp3") # collecting gems
@@ -69,6 +300,453 @@ def save_data(data_file, data):
 
     out.close()
 
+
+# Run history
+# Every run the player finishes gets saved as one row of a SQLite database, so there's a history of runs and a leaderboard.
+# Saving to the database happens in its own thread, so the game never waits for the disk:
+# end_run() only puts the run in a queue, and the thread writes everything that's waiting in one transaction.
+# Questions that get asked a lot are answered from small tables that are updated along with every run,
+# so they stay fast no matter how many runs there are:
+# terrain_stats has the totals of each terrain, and progress has the gems the player has in each terrain.
+# The game also keeps its own copy of progress in memory, which is what the menu checks to see if the player has won,
+# so the menu never waits for the writer thread (and a batch that couldn't be written doesn't make it wrong).
+
+RUN_HISTORY_FILE = "DATA/stats/run_history.db"
+RUN_HISTORY_VERSION = 1
+RUN_HISTORY_BATCH = 100 # most runs written in one transaction
+RUN_HISTORY_TIMEOUT = 10 # seconds the writer waits for another copy of the game to finish writing
+COMPLETED_GEMS = 100 # gems needed to complete a terrain
+
+run_history = {"reader": None, # connection for reading, only used by the game's thread
+               "queue": queue.Queue(), # ("run", run row) and ("progress", terrain, gems) waiting to be written
+               "writer": None, # the thread that writes them
+               "progress": {}} # terrain:gems the player has in it, the same as the text files
+
+
+def open_run_history():
+    """
+    Opens the database (and makes it, the first time) and starts the writer thread.
+    Does nothing if it's already open.
+    """
+    if run_history["reader"] is not None:
+        return
+
+    connection = sqlite3.connect(RUN_HISTORY_FILE)
+    connection.execute("PRAGMA journal_mode=WAL") # so the game can read while the writer thread writes
+    if connection.execute("PRAGMA user_version").fetchone()[0] < RUN_HISTORY_VERSION:
+        with connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS runs (
+                                      id INTEGER PRIMARY KEY,
+                                      finished TEXT, terrain TEXT, character INTEGER, seed INTEGER, seconds REAL,
+                                      coins INTEGER, gems INTEGER, spike_hits INTEGER, chunks INTEGER)""")
+            # leaderboards: best runs overall, and best runs of one terrain
+            connection.execute("CREATE INDEX IF NOT EXISTS runs_by_gems ON runs (gems DESC, coins DESC)")
+            connection.execute("CREATE INDEX IF NOT EXISTS runs_by_terrain ON runs (terrain, gems DESC, coins DESC)")
+            connection.execute("""CREATE TABLE IF NOT EXISTS terrain_stats (
+                                      terrain TEXT PRIMARY KEY, runs INTEGER, seconds REAL, coins INTEGER,
+                                      gems INTEGER, spike_hits INTEGER, chunks INTEGER, best_gems INTEGER)""")
+            connection.execute("CREATE TABLE IF NOT EXISTS progress (terrain TEXT PRIMARY KEY, gems INTEGER)")
+            connection.execute("CREATE INDEX IF NOT EXISTS progress_by_gems ON progress (gems)")
+            # players from before the database already have gems, so start from the text files
+            for terrain in terrains:
+                connection.execute("INSERT OR REPLACE INTO progress VALUES (?, ?)",
+                                   (terrain, extract_data(f"player_gems_{terrain}")[0]))
+            connection.execute(f"PRAGMA user_version = {RUN_HISTORY_VERSION}")
+    run_history["reader"] = connection
+    for terrain in terrains:
+        run_history["progress"][terrain] = extract_data(f"player_gems_{terrain}")[0]
+
+    run_history["writer"] = threading.Thread(target=write_run_history, daemon=True)
+    run_history["writer"].start()
+
+
+def write_run_history():
+    """
+    The writer thread. Waits for runs in the queue and writes them in batches.
+    The runs of a batch that can't be written are dropped (and printed), so one bad write doesn't stop the thread,
+    and finish_run_history() doesn't wait forever for it. The player's gems are tried again with the next batch.
+    """
+    connection = None
+    unsaved_progress = {} # terrain:gems from batches that couldn't be written
+    while True:
+        batch = [run_history["queue"].get()] # wait for something to write...
+        while len(batch) < RUN_HISTORY_BATCH: # ...then take everything else that's waiting too
+            try:
+                batch.append(run_history["queue"].get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            if connection is None: # sqlite connections can't be shared between threads, so the writer has its own
+                connection = sqlite3.connect(RUN_HISTORY_FILE, timeout=RUN_HISTORY_TIMEOUT)
+            with connection: # one transaction for the whole batch
+                connection.executemany("INSERT OR REPLACE INTO progress VALUES (?, ?)", unsaved_progress.items())
+                runs = []
+                for item in batch:
+                    if item[0] == "run":
+                        runs.append(item[1])
+                    else:
+                        connection.execute("INSERT OR REPLACE INTO progress VALUES (?, ?)", item[1:])
+                connection.executemany("""INSERT INTO runs (finished, terrain, character, seed, seconds, coins, gems, spike_hits, chunks)
+                                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", runs)
+                connection.executemany("""INSERT INTO terrain_stats VALUES (?2, 1, ?5, ?6, ?7, ?8, ?9, ?7)
+                                          ON CONFLICT (terrain) DO UPDATE SET
+                                          runs = runs + 1, seconds = seconds + ?5, coins = coins + ?6, gems = gems + ?7,
+                                          spike_hits = spike_hits + ?8, chunks = chunks + ?9, best_gems = max(best_gems, ?7)""", runs)
+            unsaved_progress = {}
+        except sqlite3.Error as error: # the database stayed locked by another copy of the game, the disk is full...
+            print(f"run history: couldn't save {len(batch)} items ({error})")
+            for item in batch:
+                if item[0] == "progress":
+                    unsaved_progress[item[1]] = item[2]
+        finally:
+            for item in batch:
+                run_history["queue"].task_done()
+
+
+def record_run(terrain, character, seed, seconds, coins, gems, spike_hits, chunks, total_gems):
+    """
+    Saves a finished run (coins and gems are what the run gained) and the player's new gem total for the terrain.
+    Returns right away, the writer thread does the saving.
+    """
+    open_run_history()
+    finished = datetime.now().isoformat(" ", "seconds")
+    run_history["queue"].put(("run", (finished, terrain, character, seed, seconds, coins, gems, spike_hits, chunks)))
+    record_progress(terrain, total_gems)
+
+
+def record_progress(terrain, total_gems):
+    open_run_history()
+    run_history["progress"][terrain] = total_gems
+    run_history["queue"].put(("progress", terrain, total_gems))
+
+
+def finish_run_history():
+    """
+    Waits until everything in the queue has been written. Reading right after writing needs this.
+    """
+    if run_history["reader"] is not None:
+        run_history["queue"].join()
+
+
+def count_completed_terrains():
+    """
+    Returns how many terrains the player has COMPLETED_GEMS gems in.
+    This is read from the copy of progress in memory, so it doesn't wait for the writer thread.
+    """
+    open_run_history()
+    completed = 0
+    for gems in run_history["progress"].values():
+        if gems >= COMPLETED_GEMS:
+            completed += 1
+    return completed
+
+
+def leaderboard(terrain=None, limit=10):
+    """
+    Returns the best runs (most gems, then most coins) as (terrain, character, seed, seconds, coins, gems, finished) rows.
+    """
+    open_run_history()
+    finish_run_history()
+    if terrain is None:
+        return run_history["reader"].execute("""SELECT terrain, character, seed, seconds, coins, gems, finished FROM runs
+                                                ORDER BY gems DESC, coins DESC LIMIT ?""", (limit,)).fetchall()
+    return run_history["reader"].execute("""SELECT terrain, character, seed, seconds, coins, gems, finished FROM runs
+                                            WHERE terrain = ? ORDER BY gems DESC, coins DESC LIMIT ?""", (terrain, limit)).fetchall()
+
+
+def terrain_statistics(terrain):
+    """
+    Returns (runs, seconds, coins, gems, spike hits, chunks, best gems) of every run in a terrain added together,
+    or None if the terrain hasn't been played.
+    """
+    open_run_history()
+    finish_run_history()
+    return run_history["reader"].execute("""SELECT runs, seconds, coins, gems, spike_hits, chunks, best_gems
+                                            FROM terrain_stats WHERE terrain = ?""", (terrain,)).fetchone()
+
+
+def print_leaderboard():
+    print("Best runs")
+    for place, (terrain, character, seed, seconds, coins, gems, finished) in enumerate(leaderboard(), 1):
+        print(f"{place:3}. {gems:4} gems {coins:5} coins  {terrain:7} {players[character]:7} {seconds:7.0f}s  seed {seed}  {finished}")
+    for terrain in terrains:
+        stats = terrain_statistics(terrain)
+        if stats:
+            runs, seconds, coins, gems, spike_hits, chunks, best_gems = stats
+            print(f"{terrain}: {runs} runs, {seconds/60:.0f} minutes, {coins} coins, {gems} gems (best {best_gems}), "
+                  f"{spike_hits} spike hits, {chunks} chunks")
+
+#----------------------------------
+
+# Memory instrumentation (only with --memory-trace)
+# Every time a new chunk is loaded or the screen changes (menu, shop, game...),
+# a tracemalloc snapshot is taken and compared with the one before and the very first one.
+# The lines of code whose memory grew the most, and how many Surfaces (images) are still alive,
+# get written to DATA/logs/memory_report.txt. Nothing happens between checkpoints,
+# apart from tracemalloc itself, which makes the whole game about 3 times slower while it's on
+# (a bot tick takes about 3 ms instead of 1 ms, still well inside a 60 FPS frame).
+# Comparing snapshots and looking for Surfaces are the slow parts of a checkpoint, so the game thread only
+# takes the snapshot and notes where to start looking, and a writer thread does the rest (like the telemetry does).
+
+MEMORY_REPORT_LINES = 10 # how many of the biggest growth sites to write per checkpoint
+MEMORY_REPORT_FILE = f"DATA/logs/memory_report{LOG_SUFFIX}.txt"
+
+memory_trace = {"first": None, # first snapshot, to see total growth over the session
+                "previous": None, # snapshot from the last checkpoint
+                "start": perf_counter(),
+                "checkpoints": 0,
+                "queue": queue.Queue(), # checkpoints waiting for the writer thread
+                "writer": None}
+
+if args.memory_trace:
+    tracemalloc.start(args.memory_frames)
+    os.makedirs("DATA/logs", exist_ok=True)
+    open(MEMORY_REPORT_FILE, "w").close() # start a new report every session
+
+
+def live_surfaces(containers):
+    """
+    Returns how many Surfaces the game can still reach and how many bytes of pixels they have.
+    containers are where to start: the game's global variables and the local variables of every function
+    that was running at the checkpoint (the screens call each other, so old screens' images can be kept alive
+    by functions that never returned). It looks inside every list, dict, tuple and set it finds.
+    """
+    surfaces = {}
+    looked_inside = set()
+    while containers:
+        container = containers.pop()
+        for thing in gc.get_referents(container):
+            if isinstance(thing, Surface):
+                surfaces[id(thing)] = thing
+            elif isinstance(thing, (list, dict, tuple, set)) and id(thing) not in looked_inside:
+                looked_inside.add(id(thing))
+                containers.append(thing)
+
+    pixel_bytes = 0
+    for surface in surfaces.values():
+        pixel_bytes += surface.get_pitch() * surface.get_height()
+    return len(surfaces), pixel_bytes
+
+
+def memory_checkpoint(label):
+    """
+    Writes a section of the memory report. Does nothing unless --memory-trace is on.
+    """
+    if not args.memory_trace:
+        return
+
+    snapshot = tracemalloc.take_snapshot()
+    traced, peak = tracemalloc.get_traced_memory()
+
+    roots = [globals()] # where live_surfaces() starts looking
+    depth = 0 # how many functions deep the game is, since screens call each other instead of returning
+    frame = sys._getframe()
+    while frame is not None:
+        roots.append(frame.f_locals)
+        depth += 1
+        frame = frame.f_back
+
+    memory_trace["checkpoints"] += 1
+    header = (f"=== {label} at {perf_counter() - memory_trace['start']:.1f}s | traced {traced/1024/1024:.2f} MB "
+              f"(peak {peak/1024/1024:.2f} MB) | surfaces {{}} ({{:.2f}} MB) | stack depth {depth}\n")
+
+    if memory_trace["writer"] is None:
+        memory_trace["writer"] = threading.Thread(target=write_memory_report, daemon=True)
+        memory_trace["writer"].start()
+    memory_trace["queue"].put((header, snapshot, roots))
+
+
+def write_memory_report():
+    """
+    The memory report's writer thread. Counts the Surfaces of every checkpoint memory_checkpoint() makes,
+    compares its snapshot with the one before and the first one, and writes the biggest growth to the report.
+    """
+    while True:
+        header, snapshot, roots = memory_trace["queue"].get()
+        try:
+            surface_count, surface_bytes = live_surfaces(roots)
+            roots = None # don't keep the checkpoint's variables alive until the next one
+            snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                               tracemalloc.Filter(False, "<frozen importlib._bootstrap>")])
+            out = open(MEMORY_REPORT_FILE, "a")
+            out.write(header.format(surface_count, surface_bytes/1024/1024))
+            for name, old in [("last checkpoint", memory_trace["previous"]), ("first checkpoint", memory_trace["first"])]:
+                if old is not None:
+                    out.write(f"  growth since {name}:\n")
+                    for stat in snapshot.compare_to(old, "lineno")[:MEMORY_REPORT_LINES]:
+                        if stat.size_diff > 0:
+                            frame = stat.traceback[0]
+                            out.write(f"    {stat.size_diff/1024:+10.1f} KiB {stat.count_diff:+7} blocks  {frame.filename}:{frame.lineno}\n")
+            out.close()
+
+            if memory_trace["first"] is None:
+                memory_trace["first"] = snapshot
+            memory_trace["previous"] = snapshot
+        except OSError as error:
+            print(f"memory report: couldn't write a checkpoint ({error})")
+        finally:
+            memory_trace["queue"].task_done()
+
+
+def finish_memory_report():
+    """
+    Waits until every checkpoint has been written to the report.
+    """
+    if memory_trace["writer"] is not None:
+        memory_trace["queue"].join()
+
+
+def scene_changed(scene):
+    """
+    Called at the start of every screen of the game.
+    """
+    memory_checkpoint(f"screen {scene}")
+    telemetry_event(SCENE_CHANGE, 0, 0, TELEMETRY_SCENES.index(scene))
+
+#----------------------------------
+
+# Telemetry (only with --telemetry)
+# Things that happen in the game (picking up a coin, hitting a spike...) are saved as events,
+# to find out things like where players get hurt the most and how long chunks take to cross.
+# Every event is the same size (see telemetry_record) and gets written into a buffer that was made once at the start.
+# The buffer is a ring: when the end is reached, writing goes on from the start again.
+# A separate thread copies whatever is new in the buffer to a file every TELEMETRY_FLUSH_SECONDS,
+# so the game itself never touches the disk. If the thread ever falls a whole buffer behind,
+# new events are dropped (and counted) instead of making the game wait.
+# When the file gets to TELEMETRY_FILE_BYTES, it's renamed to telemetry.bin.1 (the old .1 becomes .2 and so on)
+# and a new one is started, so there are never more than TELEMETRY_FILES files.
+
+PICKUP, SPIKE_HIT, LANDING, CHUNK_CROSSED, SCENE_CHANGE = range(5) # event types
+# what x, y and value are for each event:
+# PICKUP: column, row, 0 for a coin or 1 for a gem
+# SPIKE_HIT: column, row, gems lost
+# LANDING: player x, player y, falling speed
+LANDING_SPEED = 3 # slower than this isn't a landing, just walking (standing on the ground "falls" 1-2 pixels every other frame)
+# CHUNK_CROSSED: 1 going forward or -1 going back, 0, milliseconds spent in the chunk
+# SCENE_CHANGE: 0, 0, index in TELEMETRY_SCENES
+TELEMETRY_SCENES = ["menu", "reset", "win_screen", "character_select", "terrain_select", "game", "shop", "tutorial"]
+
+telemetry_record = struct.Struct("<dIiiii") # seconds since the start, event type, chunk number, x, y, value
+pack_telemetry = telemetry_record.pack_into # (looked up once here instead of every event)
+TELEMETRY_RECORD_SIZE = telemetry_record.size
+telemetry_header = struct.Struct("<4sHH") # "TQTE", version, record size (at the start of every file)
+TELEMETRY_VERSION = 1
+TELEMETRY_CAPACITY = 8192 # events the buffer can hold
+TELEMETRY_FLUSH_SECONDS = 0.5
+TELEMETRY_FILE_BYTES = 1 << 20 # 1 MB
+TELEMETRY_FILES = 5
+TELEMETRY_FILE = f"DATA/logs/telemetry/telemetry{LOG_SUFFIX}.bin"
+
+telemetry = {"on": False,
+             "buffer": bytearray(), # TELEMETRY_CAPACITY records
+             "head": 0, # number of events written into the buffer so far
+             "tail": 0, # number of events the writer thread has saved so far
+             "dropped": 0,
+             "start": perf_counter(),
+             "file": None,
+             "wake": threading.Event(), # set to make the writer thread save right away
+             "writer": None}
+
+
+def telemetry_event(event, x, y, value):
+    """
+    Records an event. This runs in the middle of the game, so it only packs the numbers into the buffer.
+    """
+    if not telemetry["on"]:
+        return
+    head = telemetry["head"]
+    if head - telemetry["tail"] >= TELEMETRY_CAPACITY: # the writer thread hasn't caught up
+        telemetry["dropped"] += 1
+        return
+    pack_telemetry(telemetry["buffer"], (head % TELEMETRY_CAPACITY) * TELEMETRY_RECORD_SIZE,
+                   perf_counter() - telemetry["start"], event, chunk_number, x, y, value)
+    telemetry["head"] = head + 1 # only after the record is all there, so the writer never saves half of one
+
+
+def start_telemetry():
+    os.makedirs(os.path.dirname(TELEMETRY_FILE), exist_ok=True)
+    telemetry["buffer"] = bytearray(TELEMETRY_CAPACITY * telemetry_record.size)
+    open_telemetry_file()
+    telemetry["on"] = True
+    telemetry["writer"] = threading.Thread(target=write_telemetry, daemon=True)
+    telemetry["writer"].start()
+
+
+def open_telemetry_file():
+    telemetry["file"] = open(TELEMETRY_FILE, "ab")
+    if telemetry["file"].tell() == 0:
+        telemetry["file"].write(telemetry_header.pack(b"TQTE", TELEMETRY_VERSION, telemetry_record.size))
+
+
+def rotate_telemetry_files():
+    telemetry["file"].close()
+    for n in range(TELEMETRY_FILES - 2, 0, -1): # telemetry.bin.3 -> .4, ..., .1 -> .2 (the oldest, .4, gets replaced)
+        if os.path.exists(f"{TELEMETRY_FILE}.{n}"):
+            os.replace(f"{TELEMETRY_FILE}.{n}", f"{TELEMETRY_FILE}.{n + 1}")
+    os.replace(TELEMETRY_FILE, f"{TELEMETRY_FILE}.1")
+    open_telemetry_file()
+
+
+def save_telemetry():
+    """
+    Writes the events that are new since last time to the file. Only the writer thread calls this
+    (and finish_telemetry(), after the thread is done).
+    """
+    head, tail = telemetry["head"], telemetry["tail"]
+    if head == tail:
+        return
+    size = telemetry_record.size
+    start, end = (tail % TELEMETRY_CAPACITY) * size, (head % TELEMETRY_CAPACITY) * size
+    if start < end:
+        telemetry["file"].write(telemetry["buffer"][start:end])
+    else: # the new events go past the end of the buffer and continue at the start
+        telemetry["file"].write(telemetry["buffer"][start:])
+        telemetry["file"].write(telemetry["buffer"][:end])
+    telemetry["file"].flush()
+    telemetry["tail"] = head # the space can be used again
+
+    if telemetry["file"].tell() >= TELEMETRY_FILE_BYTES:
+        rotate_telemetry_files()
+
+
+def write_telemetry():
+    while telemetry["on"]:
+        telemetry["wake"].wait(TELEMETRY_FLUSH_SECONDS)
+        telemetry["wake"].clear()
+        save_telemetry()
+
+
+def finish_telemetry():
+    """
+    Stops the writer thread and saves the last events.
+    """
+    if not telemetry["on"]:
+        return
+    telemetry["on"] = False
+    telemetry["wake"].set()
+    telemetry["writer"].join()
+    save_telemetry()
+    telemetry["file"].close()
+    if telemetry["dropped"]:
+        print(f"telemetry: {telemetry['dropped']} events were dropped")
+
+
+def read_telemetry(path):
+    """
+    Returns the events in a telemetry file as a list of
+    (seconds, event type, chunk number, x, y, value), for looking at them after playing.
+    """
+    data = open(path, "rb").read()
+    magic, version, record_size = telemetry_header.unpack_from(data)
+    if magic != b"TQTE" or version != TELEMETRY_VERSION or record_size != telemetry_record.size:
+        raise ValueError(f"{path} isn't a telemetry file this version of the game can read")
+    return list(telemetry_record.iter_unpack(data[telemetry_header.size:]))
+
+
+if args.telemetry:
+    start_telemetry()
+
 #----------------------------------
 
 # I downloaded a tileset for the graphics of my game.
@@ -85,14 +763,14 @@ dirt_terms = ["bl", "b", "rb", "rbl", # dirt tiles are different from terrain ti
 dirt_blocks = {} # will store dirt block images.
 
 coin_image = image.load(f"DATA/images/Tiles/coin_0000.png") # coin image 
+coin_image_1 = image.load(f"DATA/images/Tiles/coin_0001.png") # second frame of the coin animation
 spike_image = image.load("DATA/images/Tiles/hazards/spike.png") # spike image
 
 
-def generate_level(terrain):
+def load_terrain_images(terrain):
     """
-    The game's level is randomly generated and a 2D list is used
-    to store the type of tile that will be in that tile position in the 2D list.
-    
+    Loads the images for the tiles of a terrain.
+    Returns the terrain block images, the gem image and the decor images.
     """
     
     terrain_blocks = {} # will store terrain block images.
@@ -114,134 +792,731 @@ def generate_level(terrain):
     for d in range(3):
         decor_images.append(image.load(f"DATA/images/Tiles/platforms/terrains/{terrain}/decor_0{d}.png"))
 
-        
+    return terrain_blocks, gem_image, decor_images
 
-    # Since my game is an endless scroller, I generate a fresh level tile layouts everytime the player reaches the end of the current one.
-    # To have a smooth transition between the end of one level "chunk" and the next chunk, I want the start and end to be uniformly "blank"
-    # The "blank" layout is added to the tile layout at the end, over everything else that has been added.
-    blank_space_tiles = ((WIDTH // 2) // TILE_SIZE) + ((WIDTH // 2) // TILE_SIZE)
-    
-    level = [] # The 2D list the tile layout will be stored in.
-    for i in range(LEVEL_HEIGHT): # appending empty values 
-        level.append([0] * LEVEL_WIDTH) 
 
+# Instead of drawing from lots of tiny tile images, every tile a terrain uses is copied into one image, the "atlas",
+# the first time the terrain is played. tile_id:Rect says where in the atlas each tile is,
+# and draw_level() draws parts of the atlas (like cutting pieces out of a sprite sheet).
+# This way a whole screen of tiles can be drawn with one Surface.blits() call,
+# and the texture renderer only has to upload one image for all the tiles.
+ATLAS_COLUMNS = 8 # tiles per row of the atlas
+
+# Animated tiles
+# Some tiles flip between a few frames. Every tile of the same kind shows the same frame at the same time,
+# decided by one clock for the whole game (see animated_areas()), so nothing has to be remembered for each tile.
+# The frames are just more tiles in the atlas, and animating a tile only means drawing it from a different part of the atlas.
+ANIMATION_FRAME_MS = 250 # how long each frame shows
+
+tile_animations = {"coin": ["coin", "coin_1"], # tile id:the atlas tiles it shows one after another
+                   "gem": ["gem", "gem_1"]}
+
+tile_atlases = {} # terrain:its atlas, so each terrain's atlas is only built once
+
+def load_tile_atlas(terrain):
+    """
+    Returns the atlas of a terrain as a dictionary:
+    "image" is the atlas image, "areas" is tile_id:Rect of the tile in the atlas
+    and "animated" is the areas for each step of the animation clock (see animated_areas()).
+    """
+    if terrain in tile_atlases:
+        return tile_atlases[terrain]
+
+    terrain_blocks, gem_image, decor_images = load_terrain_images(terrain)
+    gem_image_1 = gem_image.copy() # there's only one gem image, so the second frame is a brighter "sparkle"
+    gem_image_1.fill((70, 70, 70), special_flags=BLEND_RGB_ADD)
+
+    tile_images = {"coin": coin_image, # tile_id:its image
+                   "coin_1": coin_image_1,
+                   "gem": gem_image,
+                   "gem_1": gem_image_1,
+                   "spike": spike_image,
+                   "safe_spike": spike_image,
+                   "decor_00": decor_images[0],
+                   "decor_01": decor_images[1],
+                   "decor_02": decor_images[2]}
+    tile_images.update(terrain_blocks)
+    tile_images.update(dirt_blocks)
+
+    images = [] # different tile ids can have the same image (spike and safe_spike), it only goes in once
+    for tile_image in tile_images.values():
+        if tile_image not in images:
+            images.append(tile_image)
+
+    rows = (len(images) + ATLAS_COLUMNS - 1) // ATLAS_COLUMNS
+    atlas_image = Surface((ATLAS_COLUMNS * TILE_SIZE, rows * TILE_SIZE), SRCALPHA)
+    image_areas = []
+    for i in range(len(images)):
+        area = Rect((i % ATLAS_COLUMNS) * TILE_SIZE, (i // ATLAS_COLUMNS) * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+        atlas_image.blit(images[i], area) # (the atlas starts see-through, so the tiles are copied exactly)
+        image_areas.append(area)
+
+    areas = {}
+    for tile_id in tile_images:
+        areas[tile_id] = image_areas[images.index(tile_images[tile_id])]
+
+    # The areas for each step of the animation clock, worked out now so drawing only has to pick one.
+    # After lcm() steps (the lowest number every animation's frame count goes into), all the animations start over.
+    clock_steps = 1
+    for frames in tile_animations.values():
+        clock_steps = lcm(clock_steps, len(frames))
+    animated = []
+    for step in range(clock_steps):
+        step_areas = dict(areas)
+        for tile_id, frames in tile_animations.items():
+            step_areas[tile_id] = areas[frames[step % len(frames)]]
+        animated.append(step_areas)
+
+    tile_atlases[terrain] = {"image": atlas_image, "areas": areas, "animated": animated}
+    return tile_atlases[terrain]
+
+
+def animated_areas(tile_atlas):
+    """
+    Returns tile_id:Rect in the atlas for right now, with the animated tiles on their current frame.
+    """
+    return tile_atlas["animated"][time.get_ticks() // ANIMATION_FRAME_MS % len(tile_atlas["animated"])]
+
+
+# Level generation is split into passes that run one after another (see generation_passes below).
+# Each pass gets its own random number generator made from the level's seed and the pass's name,
+# so adding a new pass, or changing one, doesn't change what the other passes generate.
+# Passes that only place things in the columns they're given are "banded":
+# the level is cut into bands of columns, and every band gets its own random generator too,
+# so a band generates the same way whatever order the bands are run in.
+# Every pass is timed, to see which one costs the most.
+
+# Since my game is an endless scroller, I generate a fresh level tile layouts everytime the player reaches the end of the current one.
+# To have a smooth transition between the end of one level "chunk" and the next chunk, I want the start and end to be uniformly "blank"
+# The "blank" layout is added to the tile layout at the end, over everything else that has been added.
+blank_space_tiles = ((WIDTH // 2) // TILE_SIZE) + ((WIDTH // 2) // TILE_SIZE)
+
+GENERATION_BAND = 38 # width of a column band. The middle of the level is 304 columns wide, so that's 8 bands.
 
+generation_timings = {} # pass name:[number of times run, total seconds, seconds the last time, most seconds]
+
+
+def pass_floor(chunk, rng, first_col, last_col):
+    level = chunk["level"]
     for x in range(LEVEL_WIDTH):# create a base layer that runs the entire width of the level
-        level[LEVEL_HEIGHT - 1][x] = "pure" # layer closest to the bottom of the screen will be a "pure" dirt block with no dark border
-        level[LEVEL_HEIGHT - 2][x] = "t" # the layer on top of the pure layer will be the terrain tile that only has a dark border on the top of the tile design.
+        level[LEVEL_HEIGHT - 1][x] = SOLID # the bottom two rows of the level are the floor.
+        level[LEVEL_HEIGHT - 2][x] = SOLID # which border each tile gets is decided later by autotile_level()
+
+
+def pass_land_masses(chunk, rng, first_col, last_col):
+    """
+    Land masses are "realistic" platforms that are built up from the floor.
+    The row of the top of each land mass column is remembered in chunk["land_tops"] for the spikes and decor.
+    """
+    level = chunk["level"]
+    y = LEVEL_HEIGHT-1
+    for i in range(first_col, last_col):
+        platform_height = rng.randint(1, 9) # random height of a platform, in terms of tiles
+        platform_width = rng.randint(1, 9) # random width
 
-    for i in range(blank_space_tiles, LEVEL_WIDTH-blank_space_tiles): # I don't want to generate anything in the reserved blank space at the start and end of level chunks.
-        platform_height = randint(1, 9) # random height of a platform, in terms of tiles
-        platform_width = randint(1, 9) # random width
+        if rng.random() < 0.2 * 2/3: # 20% chance of a platform, and 2/3 of platforms are land masses
+            for ex in range(i, min(i + platform_width, last_col)): # ex = x coord in the 2D list.
+                for row in range(platform_height+1): # starting from the bottom and building up to the top
+                    level[y-row][ex] = SOLID
+                chunk["land_tops"][ex] = min(chunk["land_tops"].get(ex, LEVEL_HEIGHT), y-platform_height)
 
-        if (random() < 0.05): # generate coins
-            coin_number = randint(3, 10) # coins are generated in "strings"
 
-            x = randint(0, LEVEL_WIDTH - 1 - coin_number) # I had to make sure the random amount of coins generated 
-            y = randint(0, LEVEL_HEIGHT-4)# wouldn't have x,y values that surpasses the level's limit.
-            for j in range(coin_number):
+def pass_floating_platforms(chunk, rng, first_col, last_col):
+    level = chunk["level"]
+    for i in range(first_col, last_col):
+        platform_width = rng.randint(1, 9)
+
+        if rng.random() < 0.2 * 1/3: # the other 1/3 of platforms float in the air
+            x = rng.randint(first_col, last_col-1)
+            y = rng.randint(2, LEVEL_HEIGHT-4)
+
+            for j in range(min(platform_width+2, last_col-x)): # a floating platform is one row of solid tiles
+                level[y][x+j] = SOLID
+
+
+CLIMB_STEP_ROWS = 4 # rows between the steps of a climb (a player with LEVEL_STATS can jump about 7)
+
+
+def pass_climbs(chunk, rng, first_col, last_col):
+    """
+    Levels are two screens tall, so climbs are how the player gets up to the top one.
+    A climb is floating platforms stacked like stairs from just above the floor up into the top screen.
+    Each step is CLIMB_STEP_ROWS above the one before and a few columns to the side,
+    so it can be jumped to (the player jumps up through platforms, and only lands on them on the way down).
+    There's a string of coins on the top step.
+    """
+    level = chunk["level"]
+    if rng.random() < 0.5: # about half of the bands get a climb
+        top = rng.randint(2, LEVEL_HEIGHT - SCREEN_ROWS) # the highest row it goes up to
+        direction = rng.choice([-1, 1])
+        width = rng.randint(3, 5)
+        x = rng.randint(first_col, last_col - width)
+        y = LEVEL_HEIGHT - 2 - CLIMB_STEP_ROWS # one step above the floor
+
+        while True:
+            for j in range(width):
+                level[y][x+j] = SOLID
+            if y - CLIMB_STEP_ROWS < top:
+                break
+
+            y -= CLIMB_STEP_ROWS
+            next_width = rng.randint(3, 5)
+            gap = rng.randint(3, 5) # columns between the end of one step and the start of the next
+            if direction == 1 and x + width + gap + next_width > last_col: # turn around at the edge of the band
+                direction = -1
+            elif direction == -1 and x - gap - next_width < first_col:
+                direction = 1
+            if direction == 1:
+                x = x + width + gap
+            else:
+                x = x - gap - next_width
+            width = next_width
+
+        for j in range(width):
+            if level[y-1][x+j] == False:
+                level[y-1][x+j] = "coin"
+
+
+def pass_collectibles(chunk, rng, first_col, last_col):
+    level = chunk["level"]
+    for i in range(first_col, last_col):
+        if rng.random() < 0.05: # generate coins
+            coin_number = rng.randint(3, 10) # coins are generated in "strings"
+
+            x = rng.randint(first_col, last_col-1)
+            y = rng.randint(0, LEVEL_HEIGHT-4)
+            for j in range(min(coin_number, last_col-x)): # make sure the string of coins doesn't go past the band
                 if level[y][x+j] == False: # To prevent coins from generating on top of tiles that are already occupying that position in the 2D layout
                     level[y][x+j] = "coin" # we can't assign coordinates in the normal "x, y" format since the format of a 2D list is that
                     # x is located INSIDE the yth list in the overall 2D list.
 
-        if (random() < 0.04): # generate gems
-            x = randint(0, LEVEL_WIDTH-1)
-            y = randint(0, LEVEL_HEIGHT-4)
+        if rng.random() < 0.04: # generate gems
+            x = rng.randint(first_col, last_col-1)
+            y = rng.randint(0, LEVEL_HEIGHT-4)
             if level[y][x] == False:
                 level[y][x] = "gem"
-        
-                
-        if (random() < 0.2) and (i + platform_width < LEVEL_WIDTH): # generate platforms
 
-            platform_type = choice(["floating", "land", "land"]) # there are 2 types of platforms,
-            # ones that float in the air, and ones that are "realistic" land masses
-            
-            if platform_type == "floating": # Generate a floating platform
 
-                x = randint(0, LEVEL_WIDTH-blank_space_tiles-2- platform_width) # Once again, make sure the platform doesn't go out of the level's limits.
-                y = randint(2, LEVEL_HEIGHT-4)
+def pass_hazards(chunk, rng, first_col, last_col):
+    level = chunk["level"]
+    for ex in range(first_col, last_col):
+        if ex in chunk["land_tops"] and rng.random() < 0.05: # generate spikes on top of land masses
+            spike_number = rng.randint(1, 9) # spikes also can appear in strings like coins.
+            sy = chunk["land_tops"][ex]-1
+            for sx in range(ex, min(ex + spike_number, last_col)):
+                if sy > 0 and level[sy][sx] == False and level[sy+1][sx] == SOLID: # spikes should'nt float, there should be a platform beneath them for realism.
+                    level[sy][sx] = "spike"
 
-                level[y][x] = "tbl" # the first block will be a terrain block that is covered on all sides except the right, since it will connect to the following tiles:
-                for j in range(1, platform_width+1):
-                    level[y][x+j] = "tb"
-                    if j == platform_width: # the last block will be like the first, but open on the left side only to connect nicely.
-                        level[y][x+j+1]  = "trb"
 
+def pass_decor(chunk, rng, first_col, last_col):
+    level = chunk["level"]
+    for sx in range(first_col, last_col):
+        if sx in chunk["land_tops"] and rng.random() < 0.5: # generate terrain-themed decor
+            sy = chunk["land_tops"][sx]-1
+            decor = rng.randint(0, 2)
+            if sy > 0 and level[sy][sx] == False and level[sy+1][sx] == SOLID: # same idea as spikes, they can't float like coins and gems can.
+                level[sy][sx] = f"decor_0{decor}"
 
-            elif platform_type == "land": # Generate land mass platform
-                
-                x, y = i, LEVEL_HEIGHT-1
-
-                for col in range(platform_width):
-                    """
-                     There are three different parts to a land mass:
-                     -The starting column
-                     -The middle column(s)
-                     -The ending column
-                     ---Some columns are only one tile wide as well.
-                     Each of these scenarios has two types of tile designs associated with it:
-                     - the terrain-themed tile that goes on the very top
-                     - the dirt tile that builds the rest of the column.
-                     
-                     The blocks dictionary below contains the tile designs associated to each scenario of column type.
-                    """
-                    blocks = { "first":("l", "tl"),  # the first column needs a left border
-                           "middle":("pure", "t"), # the middle columns(s) should be pure, without border. Only the top terrain tile should have a border. 
-                           "last":("r", "tr"), # opposite of the first column
-                           "single":("rl", "trl")} # singular columns need to be bordered on both sides.
-                    
-                    if platform_width == 1: # singular column
-                        type_col = "single"
-                    else: # else, it's a land mass that is not a single tower 
-                        if col == 0: # the first column
-                            type_col = "first" # type col is will be the key to the different scenarios in the blocks dictionary.
-                        elif col == platform_width-1: # last column
-                            type_col = "last"
-                        else: # everything else is a middle column
-                            type_col = "middle"
-
-                    ex = x+col # x = x coord in the 2D list. col = the column in the platform we're currently assigning to the 2D list.
-                    for row in range(platform_height):
-                        level[y-row][ex] = blocks[type_col][0] # starting from the bottom and building up to the top, dirt blocks
-                    level[y-platform_height][ex] = blocks[type_col][1] # the tile above those dirt blocks will be a terrain tile
-                    
-                    if (random() < 0.05) and y - platform_height - 1 > 0: # generate spikes
-                        spike_number = randint(1, platform_width) # spikes also can appear in strings like coins.
 
-                        sx = ex
-                        sy = y-platform_height-1
-                        for j in range(spike_number):
-                            if level[sy][sx+j] == False and level[sy+1][sx+j] in terrain_terms: # spikes should'nt float, there should be a platform beneath them for realism.
-                                level[sy][sx+j] = "spike" # that's why we check with "level[sy+1][sx+j]" being True to make sure there's a platform beneath.
+def pass_blank_padding(chunk, rng, first_col, last_col):
+    """
+    Now that everything else has bee generated, we add that black space at the start and end
+    for smooth transition between level generations
+    """
+    level = chunk["level"]
+    for col in list(range(0, blank_space_tiles)) + list(range(LEVEL_WIDTH - blank_space_tiles, LEVEL_WIDTH)):
+        for row in range(LEVEL_HEIGHT):
+            level[row][col] = None  # Clearing any stray tiles at the start and end of the level
 
+        level[LEVEL_HEIGHT - 1][col] = SOLID # setting the floor
+        level[LEVEL_HEIGHT - 2][col] = SOLID
 
-                    if (random() < 0.5) and y - platform_height - 1 > 0: # generate terrain-themed decor
-                        sx = ex
-                        sy = y-platform_height-1
-                        decor = randint(0, 2)
-                        
-                        if level[sy][sx] == False and level[sy+1][sx] in terrain_terms: # same idea as spikes, they can't float like coins and gems can.
-                                level[sy][sx] = f"decor_0{decor}"
 
-    # Now that everything else has bee generated, we add that black space at the start and end
-    # for smooth transition between level generations
-    
-    for col in range(0, blank_space_tiles):
-        for row in range(LEVEL_HEIGHT):
-            level[row][col] = None  # Clearing any stray tiles at the start of the level
+def pass_autotile(chunk, rng, first_col, last_col):
+    autotile_level(chunk["level"]) # give every solid tile the right terrain/dirt tile for its borders
 
-        level[LEVEL_HEIGHT - 1][col] = "pure" # pure dirt layer
-        level[LEVEL_HEIGHT - 2][col] = "t" # top terrain layer
+
+def pass_reachability(chunk, rng, first_col, last_col):
+    # Coins and gems are placed at random heights, so some of them can't actually be reached.
+    # Those get moved somewhere reachable (or removed).
+    chunk["reachable"] = find_reachable(chunk["level"], LEVEL_STATS) # (kept for the bot, see bot_controls())
+    repair_unreachable(chunk["level"], chunk["reachable"])
+
+
+# (name, function, banded) in the order they run. New kinds of content are added by adding a pass here.
+generation_passes = [("floor", pass_floor, False),
+                     ("land masses", pass_land_masses, True),
+                     ("floating platforms", pass_floating_platforms, True),
+                     ("climbs", pass_climbs, True),
+                     ("collectibles", pass_collectibles, True),
+                     ("hazards", pass_hazards, True),
+                     ("decor", pass_decor, True),
+                     ("blank padding", pass_blank_padding, False),
+                     ("autotile", pass_autotile, False),
+                     ("reachability", pass_reachability, False)]
+
+
+def generate_level(terrain, level_seed=None):
+    """
+    The game's level is randomly generated and a 2D list is used
+    to store the type of tile that will be in that tile position in the 2D list.
+    Generating with the same level_seed always gives the same level.
+    Returns the level and which of its tiles the player can reach (see find_reachable()).
+    """
+    if level_seed is None:
+        level_seed = Random().getrandbits(32)
     
-    for col in range(LEVEL_WIDTH - blank_space_tiles, LEVEL_WIDTH):# same as above but on the end of the level
-        for row in range(LEVEL_HEIGHT):
-            level[row][col] = None  
-        level[LEVEL_HEIGHT - 1][col] = "pure" # setting the floor
-        level[LEVEL_HEIGHT - 2][col] = "t" # setting the floor top layer
-        
+    level = [] # The 2D list the tile layout will be stored in.
+    for i in range(LEVEL_HEIGHT): # appending empty values 
+        level.append([0] * LEVEL_WIDTH) 
+
+    chunk = {"level": level,
+             "terrain": terrain,
+             "land_tops": {}} # passes can leave information here for the passes after them
+
+    bands = []
+    for first_col in range(blank_space_tiles, LEVEL_WIDTH-blank_space_tiles, GENERATION_BAND): # I don't want to generate anything in the reserved blank space at the start and end of level chunks.
+        bands.append((first_col, min(first_col + GENERATION_BAND, LEVEL_WIDTH-blank_space_tiles)))
+
+    for name, generation_pass, banded in generation_passes:
+        start = perf_counter()
+
+        if banded:
+            for first_col, last_col in bands:
+                generation_pass(chunk, Random(f"{level_seed}/{name}/{first_col}"), first_col, last_col)
+        else:
+            generation_pass(chunk, Random(f"{level_seed}/{name}"), 0, LEVEL_WIDTH)
+
+        seconds = perf_counter() - start
+        if name not in generation_timings:
+            generation_timings[name] = [0, 0, 0, 0]
+        timing = generation_timings[name]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = seconds
+        timing[3] = max(timing[3], seconds)
+
+    return level, chunk.get("reachable")
+
+
+def save_generation_timings():
+    """
+    Writes how long each generation pass took to a text file, slowest pass first.
+    """
+    os.makedirs("DATA/logs", exist_ok=True)
+    out = open(f"DATA/logs/generation_timings{LOG_SUFFIX}.txt", "w")
+    out.write("pass                  runs    total ms   average ms   last ms   max ms\n")
+    for name, timing in sorted(generation_timings.items(), key=lambda item: -item[1][1]):
+        runs, total, last, most = timing
+        out.write(f"{name:<20} {runs:>6} {total*1000:>11.2f} {total*1000/runs:>12.3f} {last*1000:>9.3f} {most*1000:>8.3f}\n")
+    out.close()
+
+
+# Generating a chunk takes around 20 ms (mostly the reachability flood), which is more than a whole frame,
+# so doing it on the frame the player crosses into the chunk made the game skip a couple of frames.
+# Instead the next chunk is generated on its own thread while the player is still in the current one.
+# The game thread spends most of every frame waiting for the clock, so the generating thread gets to run then.
+# If the player gets to the next chunk before it's ready, the game just waits for the rest of it.
+
+level_ahead = {"pool": None, # one thread that generates levels, made the first time it's needed
+               "seed": None, # seed of the level being generated ahead
+               "future": None}
+
+
+def generate_level_ahead(terrain, level_seed):
+    """
+    Starts generating a level on the level thread, for generated_level() to pick up later.
+    """
+    if level_ahead["seed"] == level_seed: # already on it
+        return
+    if level_ahead["pool"] is None:
+        level_ahead["pool"] = ThreadPoolExecutor(1)
+    level_ahead["seed"] = level_seed
+    level_ahead["future"] = level_ahead["pool"].submit(generate_level, terrain, level_seed)
+
+
+def generated_level(terrain, level_seed):
+    """
+    Returns the level for a seed and which of its tiles can be reached, like generate_level().
+    It was usually already generated ahead (see generate_level_ahead()). If it wasn't, it's generated now.
+    """
+    if level_ahead["seed"] != level_seed:
+        return generate_level(terrain, level_seed)
+
+    level, reachable = level_ahead["future"].result() # (waits for it if it isn't done yet)
+    level_ahead["seed"] = None
+    level_ahead["future"] = None
+    return level, reachable
+
+
+def finish_level_ahead():
+    """
+    Waits for the level being generated ahead (if there is one) and forgets it, at the end of a run.
+    """
+    if level_ahead["future"] is not None:
+        level_ahead["future"].result()
+    level_ahead["seed"] = None
+    level_ahead["future"] = None
+
+
+#----------------------------------
+
+# Reachability
+# To know if the player can reach a coin or gem, I simulate the same physics move_player() uses
+# (x moves by SPEED per tick, jumping sets VY to -AGILITY, y += VY and then VY += 1 every tick, up to TERMINAL_VY).
+# Simulating every jump from every tile would be way too slow to do while generating a level,
+# so the jumps are simulated once per (speed, agility) pair and saved as "templates" of which tile offsets
+# the player's body passes through. Flooding a level then just means stamping those templates
+# onto the 2D list starting from every tile the player can stand on.
+
+jump_arc_templates = {} # (speed, agility, player size):list of arcs, so each pair of stats is only simulated once.
+
+REACH_COLLECTIBLES = ["coin", "gem"] # tile ids that have to be reachable
+
+# Levels are made reachable for the speed and agility every player starts with, not the player's own upgrades,
+# so a seed gives the same level to everyone (sharing a seed, ghost races).
+LEVEL_STATS = extract_data("default/player_stats")
+
+
+def get_jump_arcs(speed, agility):
+    """
+    Returns the jump arc templates for a pair of player stats, simulating them the first time they are asked for.
+    Each arc is a list of steps. Each step is (body_cells, land_row, land_cols)
+    where the cells are (row, col) offsets from the tile the player is standing on.
+    A step only has the cells the player's body gets to for the first time in that arc,
+    since the cells it was already in have been checked by the steps before it.
+    land_row is None unless the player's feet crossed the top of a tile row in that step.
+    The arcs depend on the size of the player's body too (guy[SIZE]), so that's part of the key.
+    """
+    speed = max(speed, 0) # with enough "speed_minus" upgrades the player can't walk at all.
+    size = guy[SIZE]
+    if (speed, agility, size) in jump_arc_templates:
+        return jump_arc_templates[(speed, agility, size)]
+
+    # Every arc is a starting x offset, a horizontal speed and a starting VY.
+    # Holding left/right for only part of a jump moves you less far, so I also simulate half speed jumps.
+    arc_starts = []
+    for direction in [-1, 1]:
+        for fraction in [0.5, 1]:
+            arc_starts.append((0, direction * speed * fraction, -agility)) # jumps
+        if speed > 0:
+            arc_starts.append((direction * TILE_SIZE, direction * speed, 0)) # walking onto the next tile / falling off a ledge
+    arc_starts.append((0, 0, -agility)) # jumping straight up
+
+    arcs = []
+    for x, vx, vy in arc_starts:
+        y = -size # standing on top of tile row 0, so the player's feet are at y = 0
+        steps = []
+        seen = set() # cells the body has already been in
+        landings = set() # landings already checked
+        for tick in range(500):
+            old_bottom = y + size
+            x += vx
+            y += vy
+            vy = min(vy + 1, TERMINAL_VY)
+
+            top_row, bottom_row = int(y // TILE_SIZE), int((y + size - 1) // TILE_SIZE)
+            left_col, right_col = int(x // TILE_SIZE), int((x + size - 1) // TILE_SIZE)
+
+            land_row = None
+            if y + size > old_bottom and old_bottom <= bottom_row * TILE_SIZE: # the feet crossed the top of bottom_row this tick
+                land_row = bottom_row
+
+            body = []
+            for row in range(top_row, bottom_row + 1):
+                if row != land_row: # the row being landed on isn't part of the body
+                    for col in range(left_col, right_col + 1):
+                        if (row, col) not in seen:
+                            seen.add((row, col))
+                            body.append((row, col))
+
+            land_cols = tuple(range(left_col, right_col + 1))
+            if (land_row, land_cols) in landings: # when moving slowly, lots of ticks cover exactly the same tiles.
+                land_row = None
+            if body or land_row is not None:
+                steps.append((tuple(body), land_row, land_cols))
+                landings.add((land_row, land_cols))
+
+            if top_row > LEVEL_HEIGHT: # fell further than the whole level is tall
+                break
+        arcs.append(steps)
+
+    jump_arc_templates[(speed, agility, size)] = arcs
+    return arcs
+
+
+def find_reachable(level, player_stats):
+    """
+    Floods the level from the start of the chunk, using the jump arc templates,
+    and returns a 2D list of True/False for whether the player's body can get to each tile.
+    This is an approximation: landing positions are snapped to whole tiles,
+    and a jump that bumps into a solid tile is treated as stopping there.
+    """
+    arcs = get_jump_arcs(player_stats[SPEED], player_stats[AGILITY])
+
+    # The flood stamps thousands of cells per tile the player can stand on, so it works on flat 1D lists
+    # with a border of extra cells around the level: then a cell is just "where the player stands + offset",
+    # without checking if it's inside the level first. The border is solid at the sides and below the level
+    # (you can't go there), and empty above it (move_player() keeps the player on screen, so tiles above the level don't matter).
+    rows = [row for arc in arcs for body, land_row, land_cols in arc for row, col in body]
+    rows += [land_row for arc in arcs for body, land_row, land_cols in arc if land_row is not None]
+    cols = [col for arc in arcs for body, land_row, land_cols in arc for col in land_cols]
+    above, below = max([0] + [-row for row in rows]), max([0] + rows)
+    left, right = max([0] + [-col for col in cols]), max([0] + cols)
+    width = left + LEVEL_WIDTH + right
+
+    solid = [False] * (above * width) # which cells you can't walk through
+    landable = [False] * (above * width) # which cells you can land on (check_collision() only lets you land on terrain tiles)
+    for row in level:
+        solid += [True] * left + [tile_id in solid_terms for tile_id in row] + [True] * right
+        landable += [False] * left + [tile_id in terrain_terms for tile_id in row] + [False] * right
+    solid += [True] * (below * width)
+    landable += [False] * (below * width)
+
+    # The templates as offsets in the flat lists. Steps that can't land are joined onto the step after them,
+    # so there's one (cells, landing cells) pair per landing check.
+    flat_arcs = []
+    for arc in arcs:
+        flat_arc = []
+        cells = []
+        for body, land_row, land_cols in arc:
+            cells += [row * width + col for row, col in body]
+            if land_row is not None:
+                flat_arc.append((tuple(cells), tuple(land_row * width + col for col in land_cols)))
+                cells = []
+        flat_arc.append((tuple(cells), ()))
+        flat_arcs.append(flat_arc)
+
+    reachable = [False] * len(solid)
+    standing = [False] * len(solid) # cells the player has been found to be able to stand on
+
+    # The player always starts the chunk standing on the floor at guy[START_X].
+    start = (above + LEVEL_HEIGHT - 2) * width + left + guy[START_X] // TILE_SIZE
+    standing[start] = True
+    to_visit = [start]
+
+    while to_visit:
+        ground = to_visit.pop()
+
+        for arc in flat_arcs:
+            for cells, landing in arc:
+                blocked = False
+                for cell in cells:
+                    if solid[ground + cell]:
+                        blocked = True
+                        break
+                    reachable[ground + cell] = True
+                if blocked:
+                    break
+
+                landed = False
+                for cell in landing:
+                    if landable[ground + cell]:
+                        landed = True
+                        break
+                if landed:
+                    stand = ground + landing[0] # the player's left side decides where they stand
+                    if not standing[stand]:
+                        standing[stand] = True
+                        to_visit.append(stand)
+                    break
+
+    level_reachable = [] # back to a 2D list the size of the level
+    for row in range(LEVEL_HEIGHT):
+        first = (above + row) * width + left
+        level_reachable.append(reachable[first:first + LEVEL_WIDTH])
+    return level_reachable
+
+
+def repair_unreachable(level, reachable):
+    """
+    Moves every coin and gem the player can't reach down its column to the closest reachable empty tile.
+    If there isn't one, it is removed.
+    """
+    for row in range(LEVEL_HEIGHT - 1, -1, -1): # bottom up, so moved items don't get checked twice
+        for col in range(LEVEL_WIDTH):
+            tile_id = level[row][col]
+            if tile_id in REACH_COLLECTIBLES and not reachable[row][col]:
+                level[row][col] = None
+                for new_row in range(row + 1, LEVEL_HEIGHT):
+                    if level[new_row][col]: # can't fall through platforms
+                        break
+                    if reachable[new_row][col]:
+                        level[new_row][col] = tile_id
+                        break
+
 
-    return level, terrain_blocks, gem_image, decor_images
 
+#----------------------------------
+
+# Autotiling
+# Instead of picking border tiles while placing platforms (which looked wrong whenever platforms overlapped),
+# generate_level() only places SOLID tiles, and the border of every solid tile is worked out afterwards
+# from which of its 4 neighbours are empty.
+
+SOLID = "solid" # placeholder tile id for "some kind of ground goes here"
+
+solid_terms = set(terrain_terms + dirt_terms + [SOLID]) # every tile id you can't walk through
+
+# Each side that touches an empty tile gets a dark border, so the 4 sides make a 4 bit number (t=8, r=4, b=2, l=1).
+# autotile_table[bits] is the tile id for that combination of borders.
+# If the top is open, it's a terrain tile (grass/snow/sand on top). Otherwise it's a dirt tile.
+autotile_table = []
+for bits in range(16):
+    tile_id = ""
+    for side_bit, side in [(8, "t"), (4, "r"), (2, "b"), (1, "l")]:
+        if bits & side_bit:
+            tile_id += side
+    if tile_id == "":
+        tile_id = "pure" # dirt with no borders at all
+    autotile_table.append(tile_id)
+
+
+def autotile_level(level):
+    """
+    Replaces every solid tile in the level with the terrain or dirt tile that has the right borders.
+    The whole level is done in one pass, one row at a time,
+    by lining each row up with the rows above and below it and itself shifted left and right.
+    Past the bottom, left and right edges counts as solid (the floor and the next chunk continue there),
+    past the top counts as empty.
+    """
+    solid = []
+    for row in level:
+        solid.append([tile_id in solid_terms for tile_id in row])
+
+    empty_row = [False] * LEVEL_WIDTH
+    full_row = [True] * LEVEL_WIDTH
+
+    for r in range(LEVEL_HEIGHT):
+        here = solid[r]
+        above = solid[r-1] if r > 0 else empty_row
+        below = solid[r+1] if r < LEVEL_HEIGHT-1 else full_row
+        left = [True] + here[:-1]
+        right = here[1:] + [True]
+
+        level[r] = [autotile_table[(not a)*8 + (not rt)*4 + (not b)*2 + (not lt)]  if s else tile_id
+                    for tile_id, s, a, rt, b, lt in zip(level[r], here, above, right, below, left)]
+
+
+#----------------------------------
+
+# Chunk store
+# Every level chunk the player leaves is saved to a file, so they can walk back into it later.
+# Chunks just get added onto the end of the file. Each chunk is its tile ids turned into one byte each
+# (see tile_codes) and compressed, since most of a level is empty air.
+# The store's "index" remembers where in the file each chunk starts,
+# so any chunk can be read straight out of a memory-mapped file without reading the whole thing.
+# Only the last few chunks used are kept in memory as 2D lists, so memory doesn't grow the longer a run goes.
+# The file only lasts as long as the run. Sharing levels doesn't need it: the same seed generates the same chunks.
+
+CHUNK_CACHE_SIZE = 4 # max number of chunks kept in memory (the LRU working set)
+
+chunk_record = struct.Struct("<iI") # chunk number, length of the compressed tiles that follow
+
+# tile id:byte. Empty tiles (0/None/False) are 0.
+tile_codes = [None] + terrain_terms + dirt_terms + ["coin", "gem", "spike", "safe_spike", "decor_00", "decor_01", "decor_02"]
+tile_code_of = {}
+for code in range(1, len(tile_codes)):
+    tile_code_of[tile_codes[code]] = code
+
+RUN_SEED = args.seed # --seed replays (or shares) the levels of a run. None picks a new seed every run.
+
+
+def chunk_seed(run_seed, terrain, chunk_number):
+    """
+    Every chunk of a run gets its own seed made from the run's seed,
+    so the same run seed always generates the same chunks in the same order.
+    """
+    return f"{run_seed}/{terrain}/{chunk_number}"
+
+
+def open_chunk_store():
+    """
+    Creates a new chunk store file for a run and returns a dictionary with everything needed to use it.
+    """
+    # The store is only needed while its run is going, and copies of the game running at the same time
+    # (ghost races, --bot-processes) each need their own. So it's kept in a temporary file that doesn't have a name:
+    # there's nothing for two copies to clash on, and it gets deleted when it's closed, even if the game crashes first.
+    return {"file": tempfile.TemporaryFile(),
+            "index": {}, # chunk number:(offset, length) of the newest copy of that chunk
+            "map": None, # memory map of the file, re-made when the file has grown past it
+            "cache": OrderedDict()} # chunk number:2D list, least recently used first
+
+
+def close_chunk_store(store):
+    if store["map"] is not None:
+        store["map"].close()
+    store["file"].close()
+    store["cache"].clear()
+
+
+def cache_chunk(store, chunk_number, level):
+    """
+    Puts a chunk in the in-memory working set, forgetting the least recently used chunk if it's full.
+    """
+    store["cache"][chunk_number] = level
+    store["cache"].move_to_end(chunk_number)
+    while len(store["cache"]) > CHUNK_CACHE_SIZE:
+        store["cache"].popitem(last=False)
+
+
+def level_codes(level):
+    """
+    Returns the tile codes of a level, one byte per tile, row after row (empty tiles are 0).
+    """
+    codes = bytearray()
+    for row in level:
+        for tile_id in row:
+            if tile_id:
+                codes.append(tile_code_of[tile_id])
+            else:
+                codes.append(0)
+    return codes
+
+
+def store_chunk(store, chunk_number, level):
+    """
+    Adds a chunk onto the end of the store (coins that were collected stay collected).
+    If the chunk was stored before, the index just points to the newer copy.
+    """
+    tiles = zlib.compress(bytes(level_codes(level)))
+
+    offset = store["file"].seek(0, os.SEEK_END)
+    store["file"].write(chunk_record.pack(chunk_number, len(tiles)) + tiles)
+    store["file"].flush()
+
+    store["index"][chunk_number] = (offset, chunk_record.size + len(tiles))
+
+    cache_chunk(store, chunk_number, level)
+
+
+def load_chunk(store, chunk_number):
+    """
+    Returns the 2D list of a stored chunk, or None if that chunk hasn't been stored yet.
+    """
+    if chunk_number in store["cache"]:
+        store["cache"].move_to_end(chunk_number)
+        return store["cache"][chunk_number]
+
+    if chunk_number not in store["index"]:
+        return None
+
+    offset, length = store["index"][chunk_number]
+    if store["map"] is None or offset + length > len(store["map"]): # the file grew since it was last mapped
+        if store["map"] is not None:
+            store["map"].close()
+        store["map"] = mmap.mmap(store["file"].fileno(), 0, access=mmap.ACCESS_READ)
+
+    number, tiles_length = chunk_record.unpack_from(store["map"], offset)
+    start = offset + chunk_record.size
+    codes = zlib.decompress(store["map"][start:start + tiles_length])
+
+    level = []
+    for row in range(LEVEL_HEIGHT):
+        level.append([tile_codes[c] for c in codes[row * LEVEL_WIDTH:(row + 1) * LEVEL_WIDTH]])
+
+    cache_chunk(store, chunk_number, level)
+    return level
 
 
 # Since the background was also given as tiles in the tileset I downloaded,
@@ -291,23 +1566,32 @@ running = {"menu":False,
            
            } # each different mode of the game is in its own function with its own while loop that is running separately.
 
+chunk_number = 0 # which chunk of the current run the player is in. The first chunk is 0.
+chunk_step = 1 # 1 when the player is going on to the next chunk, -1 when going back to the one before.
+
+# What happens during a run, for the run history (see record_run())
+run_record = {"character": 0, # set when the character is picked
+              "seed": 0,
+              "start": 0, # perf_counter() when the run started
+              "coins": 0, "gems": 0, # what the player had when the run started
+              "spike_hits": 0,
+              "chunks": 0} # how many times the player went into another chunk
+
 completed_terrains = 0 # checks if the game was been won by the player
 # After the player has beat the game, each time they open up the game to play again,
 # they will be reminded of the fact that they beat the game.
 
 def main_menu():
     global game_started, completed_terrains
+    scene_changed("menu")
 
     # check each time the player returns to the menu after running a terrain or opening the game again
     # if they've beat the game or not.
-    for p in range(len(terrains)): # For each terrain that has the required amount of gems,
-        if extract_data(f"player_gems_{terrains[p]}")[0] >= 100: # increment the completed_terrains variable to keep track of the fact
-            completed_terrains += 1
+    already_won = completed_terrains == 3 # the win screen's back button comes back here, so it only shows when they've just won
+    completed_terrains = count_completed_terrains() # the number of terrains with the required amount of gems (see run history)
 
-    if completed_terrains == 3: # If they've got 100 gems in each terrain, they've won.
+    if completed_terrains == 3 and not already_won: # If they've got 100 gems in each terrain, they've won.
         win_screen()
-    elif completed_terrains < 3: # If they haven't fully finished the game, reset that variable to prevent unwanted incrementation
-        completed_terrains = 0
         
 
     MENU_TILE = TILE_SIZE*2 # Spacings between menu objects are bigger than between game/level layout tiles
@@ -354,7 +1638,7 @@ def main_menu():
 
     running["menu"] = True
     while running["menu"]:
-        for e in event.get():
+        for e in get_events():
             if e.type == QUIT:
                 running["menu"] = False
             if e.type == MOUSEBUTTONDOWN:
@@ -375,7 +1659,7 @@ def main_menu():
                             running["menu"] = False
                             
         
-        display.flip()
+        present()
   
 #----------------------------------
 
@@ -388,6 +1672,7 @@ def reset_confirm():
     Since the program saves the player's progress, it also gives the option to restart the game by resetting all progress.
     This function asks the user for confirming the  reset in case they accidentally pressed the reset button in the menu.
     """
+    scene_changed("reset")
     screen.blit(generate_background("green"), (0,0))
     confirm_image = image.load("DATA/images/menu/reset_confirmation.png")
     screen.blit(confirm_image, (WIDTH//2-confirm_image.get_width()//2, HEIGHT//2-confirm_image.get_height()//2 ))
@@ -406,7 +1691,7 @@ def reset_confirm():
 
     running["reset"] = True
     while running["reset"]:
-        for e in event.get():
+        for e in get_events():
             if e.type == QUIT:
                 running["reset"] = False
             if e.type == MOUSEBUTTONDOWN:
@@ -423,6 +1708,8 @@ def reset_confirm():
                         for r in reset_values:
                             default = extract_data(f"default/{r}") # there's a folder filled with all the default values, copies of each data file
                             save_data(r, default)
+                        for terrain in terrains: # the run history keeps the player's gems too (the old runs stay in the history)
+                            record_progress(terrain, extract_data(f"player_gems_{terrain}")[0])
                             
                         main_menu() # back the main menu once the act is done
                         running["reset"] = False
@@ -432,11 +1719,12 @@ def reset_confirm():
                         main_menu()
                         running["reset"] = False
 
-        display.flip()
+        present()
                         
 
 def win_screen():
     # The user has beat the main goal of the game...
+    scene_changed("win_screen")
 
     screen.fill(0)
     screen.blit(image.load("DATA/images/relic.png"), (0,0)) 
@@ -445,7 +1733,7 @@ def win_screen():
 
     running["win_screen"] = True
     while running["win_screen"]:
-        for e in event.get():
+        for e in get_events():
             if e.type == QUIT: # :(
                 running["win_screen"] = False
             if e.type == MOUSEBUTTONDOWN: 
@@ -454,7 +1742,7 @@ def win_screen():
                         main_menu()
                         running["win_screen"] = False
 
-        display.flip()
+        present()
 
 
 
@@ -467,6 +1755,7 @@ def character_select():
     """
     Before the actual game can be played, the player chooses a character to play as.
     """
+    scene_changed("character_select")
     
     unlocked_players = extract_data("unlocked_players") # however they need to unlock characters before being able to play as them
     
@@ -501,7 +1790,7 @@ def character_select():
     
     running["character_select"] = True
     while running["character_select"]:
-        for e in event.get():
+        for e in get_events():
             if e.type == QUIT:
                 running["character_select"] = False
             if e.type == MOUSEBUTTONDOWN:
@@ -512,12 +1801,13 @@ def character_select():
                 for p in range(len(players)):
                     if select_rects[p].collidepoint(e.pos) and unlocked_players[p]: # if the player clicks an unlocked option
                         player_frames = generate_player(p) # load the selected character's animation frames
+                        run_record["character"] = p
             
                         terrain_select(player_frames) # next the player needs to choose what terrain 
                         running["character_select"] = False
                         
         
-        display.flip()
+        present()
 
 
 LEFT, RIGHT = 0, 1  # constant indexes where the left facing and right facing images will be stored
@@ -541,6 +1831,7 @@ def generate_player(selected_player):
 
 pixel_font24 = font.Font("DATA/PressStart2P-Regular.ttf", 24) # font size 24
 pixel_font18 = font.Font("DATA/PressStart2P-Regular.ttf", 18) # font size 18
+pixel_font12 = font.Font("DATA/PressStart2P-Regular.ttf", 12) # font size 12
 
 terrains = ["forest", # the 3 different terrains you can play in.
             "tundra",
@@ -550,6 +1841,7 @@ def terrain_select(player_frames): # player frames are passed into terrain selec
     """
     After selecting a character to play as, select the terrain you want to play in before the real game begins.
     """
+    scene_changed("terrain_select")
     unlocked_terrains = extract_data("unlocked_terrains") # essentially the same code as with the character select
     # But I made the entire image for each selecting profile on canva so there is less complex coord assigning/blitting of images.
     
@@ -595,7 +1887,7 @@ def terrain_select(player_frames): # player frames are passed into terrain selec
     
     running["terrain_select"] = True
     while running["terrain_select"]:
-        for e in event.get():
+        for e in get_events():
             if e.type == QUIT:
                 running["terrain_select"] = False
             if e.type == MOUSEBUTTONDOWN:
@@ -609,16 +1901,17 @@ def terrain_select(player_frames): # player frames are passed into terrain selec
                         running["terrain_select"] = False
                         
         
-        display.flip()
+        present()
 
 
 ######################################################################
 
 # the player's data is more easy to manage as a list.
-guy = [0,0,  2, True,False, 0,WIDTH//2,0, 1,5, 24]
+guy = [0,0,  2, True,False, 0,WIDTH//2,0, 1,5, 24, 0,0]
 
 # The below constants are the indexes at which each of the player's data is found in the list
-X,Y,VY, ONGROUND,MOVING, FRAME,START_X,SCROLL_Y, DIRECTION,SPEED, SIZE = 0,1, 2,3,4, 5,6,7, 8,9, 10
+X,Y,VY, ONGROUND,MOVING, FRAME,START_X,SCROLL_Y, DIRECTION,SPEED, SIZE, MOVED_X,MOVED_Y = 0,1, 2,3,4, 5,6,7, 8,9, 10, 11,12
+# (MOVED_X/MOVED_Y are how far the last move_player() actually moved the player, see check_collision())
 
 
 
@@ -627,126 +1920,437 @@ SPEED, AGILITY, GEM_RESIST, COIN_RESIST = 0, 1, 2, 3 # these are also constants
 # agility = jump power
 #Gem and coin resist is the number of item you lose when you touch a spike. you can upgrade in the shop to reduce the number of item you lose.
 
-def run_game(player_frames, current_terrain):
+#----------------------------------
+
+# Quality governor
+# On slow computers the game can't keep up with 60 frames per second, so optional work gets skipped.
+# The time each frame takes (not counting the time myClock.tick(60) waits) is compared to the 1/60 s budget.
+# If frames are too slow for a while, the quality goes down a tier. If there's been lots of time to spare
+# for much longer, it goes back up a tier. The waits and thresholds are different on the way up and down
+# so the quality doesn't flicker between two tiers.
+
+QUALITY_TIERS = ["full", # tier 0: everything is drawn
+                 "no decor", # tier 1: decor tiles aren't drawn
+                 "flat background", # tier 2: the background image is replaced with one colour
+                 "no minimap or ghosts"] # tier 3: the see-through minimap and ghosts aren't drawn (ghosts still get sent)
+QUALITY_SKIPPED_TILES = [set(), {"decor_00", "decor_01", "decor_02"},
+                         {"decor_00", "decor_01", "decor_02"}, {"decor_00", "decor_01", "decor_02"}]
+# There's no "lower resolution" tier. Drawing the game at half size and scaling it up in present() was tried:
+# a frame is mostly the cost of each blit, not of how many pixels it has, so drawing at half size saved less
+# than the extra scaling cost (0.98 ms a frame instead of 0.68 ms).
+
+FRAME_BUDGET = 1000 / 60 # milliseconds per frame at 60 FPS
+QUALITY_WINDOW = 60 # frames averaged together
+QUALITY_DOWN = 0.9 # go down a tier when the average is over 90% of the budget...
+QUALITY_DOWN_FRAMES = 30 # ...for this many frames in a row
+QUALITY_UP = 0.5 # go up a tier when the average is under 50% of the budget...
+QUALITY_UP_FRAMES = 300 # ...for this many frames in a row (5 seconds)
+
+quality = {"tier": 0,
+           "frame_times": deque(maxlen=QUALITY_WINDOW), # milliseconds of the last frames
+           "average": 0,
+           "slow_frames": 0,
+           "fast_frames": 0}
+
+
+def update_quality(frame_ms):
+    """
+    Called once per frame with how many milliseconds of work the frame was.
+    """
+    quality["frame_times"].append(frame_ms)
+    quality["average"] = sum(quality["frame_times"]) / len(quality["frame_times"])
+
+    if quality["average"] > FRAME_BUDGET * QUALITY_DOWN:
+        quality["slow_frames"] += 1
+        quality["fast_frames"] = 0
+    elif quality["average"] < FRAME_BUDGET * QUALITY_UP:
+        quality["fast_frames"] += 1
+        quality["slow_frames"] = 0
+    else:
+        quality["slow_frames"] = 0
+        quality["fast_frames"] = 0
+
+    if quality["slow_frames"] >= QUALITY_DOWN_FRAMES and quality["tier"] < len(QUALITY_TIERS) - 1:
+        set_quality(quality["tier"] + 1)
+    elif quality["fast_frames"] >= QUALITY_UP_FRAMES and quality["tier"] > 0:
+        set_quality(quality["tier"] - 1)
+
+
+def set_quality(tier):
+    quality["tier"] = tier
+    quality["frame_times"].clear() # the frames before the change don't say anything about the new tier
+    quality["slow_frames"] = 0
+    quality["fast_frames"] = 0
+
+
+def draw_background(background_image):
+    if quality["tier"] >= 2:
+        fill_screen(background_image.get_at((0, 0))) # the colour of the sky
+    else:
+        draw_image(background_image, (0,0))
+
+
+# The overlay (toggled with F3) shows how the game is running.
+overlay = {"on": False, "text": None, "frame": 0}
+OVERLAY_FRAMES = 15 # the overlay text is only updated 4 times a second
+
+def draw_overlay(myClock):
+    if not overlay["on"]:
+        return
+    overlay["frame"] += 1
+    if overlay["text"] is None or overlay["frame"] % OVERLAY_FRAMES == 0:
+        overlay["text"] = pixel_font12.render(f"{myClock.get_fps():.0f} fps  {quality['average']:.1f} ms  "
+                                              f"quality {quality['tier']} {QUALITY_TIERS[quality['tier']]}  chunk {chunk_number}",
+                                              True, (255, 255, 255), (0, 0, 0))
+    draw_image(overlay["text"], (10, HEIGHT - button_rect.height - 40))
+
+
+def run_game(player_frames, current_terrain, bot=None):
     """
     Runs all the functions necessary to play the actual game.
+    If a bot is given (see start_bot()), the bot presses the keys instead of the player.
     """
-    global guy, game_started
+    global guy, game_started, chunk_number, chunk_step
+    scene_changed("game")
     
     background_image = generate_background(current_terrain)
+    tile_atlas = load_tile_atlas(current_terrain)
+    gem_image = tile_atlas["image"].subsurface(tile_atlas["areas"]["gem"]) # for the HUD
     
     player_coins = extract_data("player_coins")
     player_gems = extract_data(f"player_gems_{current_terrain}")
     player_stats = extract_data("player_stats")
 
+    run_seed = RUN_SEED
+    race_seed = ghost_seed()
+    if race_seed is not None: # racing ghosts means playing the same chunks as them
+        run_seed = race_seed
+    if run_seed is None:
+        run_seed = Random().getrandbits(32)
+    chunk_store = open_chunk_store()
+    seed_text = pixel_font12.render(f"seed {run_seed}", True, (255, 255, 255)) # so players can share the seed of a good run
+    ghost_frames = start_ghosts(run_seed, player_frames)
+    run_record.update(seed=run_seed, start=perf_counter(), coins=player_coins[0], gems=player_gems[0], spike_hits=0, chunks=0)
+    level = None
+    chunk_number = 0
+    chunk_step = 1
+
 
     myClock = time.Clock()
     running["game"] = True
     while running["game"]:
-        for e in event.get():
+        frame_start = perf_counter()
+        for e in get_events():
             if e.type == QUIT: # save player progress when they quit the program
-                save_data("player_coins", player_coins)
-                save_data(f"player_gems_{current_terrain}", player_gems)
+                end_run(current_terrain, player_coins, player_gems, chunk_store, bot)
                 running["game"] = False
+            if e.type == KEYDOWN and e.key == K_F3: # show/hide the overlay
+                overlay["on"] = not overlay["on"]
             if e.type == MOUSEBUTTONDOWN:
                 if e.button == 1:
                     if button_rect.collidepoint(e.pos): # back to the menu
-                        save_data("player_coins", player_coins) # save player progress
-                        save_data(f"player_gems_{current_terrain}", player_gems)
+                        end_run(current_terrain, player_coins, player_gems, chunk_store, bot)
                         
                         main_menu()
                         running["game"] = False
 
 
-        screen.blit(background_image, (0,0))
+        draw_background(background_image)
 
         if not game_started:
             """
             Whenver game is considered not started, all values are reset/re-generated.
-            This variable is set to false when the player collides with the end of the current level chunk, see check_collide() function.
+            This variable is set to false when the player collides with the end (or start) of the current level chunk, see check_collide() function.
             """
-            level, terrain_blocks, gem_image, decor_images = generate_level(current_terrain)
-            guy[X]= guy[START_X]
+            if level is not None: # save the chunk being left so the player can come back to it
+                store_chunk(chunk_store, chunk_number, level)
+                telemetry_event(CHUNK_CROSSED, chunk_step, 0, int((perf_counter() - chunk_start) * 1000))
+                chunk_number += chunk_step
+                run_record["chunks"] += 1
+
+            level = load_chunk(chunk_store, chunk_number) # chunks the player has already been in come from the store,
+            reachable = None # (only known for chunks that were just generated)
+            if level is None: # new ones are generated (usually while the player was still in the chunk before)
+                level, reachable = generated_level(current_terrain, chunk_seed(run_seed, current_terrain, chunk_number))
+            memory_checkpoint(f"chunk {chunk_number}") # (before the level thread starts, so it doesn't have to wait for it)
+            if chunk_number + 1 not in chunk_store["index"]: # start on the next chunk while this one is played
+                generate_level_ahead(current_terrain, chunk_seed(run_seed, current_terrain, chunk_number + 1))
+            chunk_start = perf_counter() # for telemetry
+            build_minimap(level)
+
+            if chunk_step > 0:
+                guy[X]= guy[START_X]
+            else: # walking back into the previous chunk, so start at its end
+                guy[X] = LEVEL_WIDTH * TILE_SIZE - WIDTH//2 - guy[SIZE] - TILE_SIZE
             
             game_started = True
         
-        draw_level(guy, level, terrain_blocks, gem_image, player_frames, decor_images, player_coins, player_gems)
+        update_camera(guy)
+        draw_level(guy, level, tile_atlas, gem_image, player_coins, player_gems)
+        draw_minimap(guy)
         
-        moving_right, moving_left = check_collision(guy, level, player_stats, player_coins, player_gems)
-        move_player(guy, moving_right, moving_left, player_frames, player_stats)
+        if bot is None:
+            keys = key.get_pressed()
+        else:
+            keys = bot_controls(bot, guy, level, reachable, player_stats)
+
+        steps = physics_steps(guy, player_stats, keys)
+        for step in range(steps):
+            moving_right, moving_left = check_collision(guy, level, player_stats, player_coins, player_gems, steps)
+            move_player(guy, moving_right, moving_left, player_frames, player_stats, keys, step, steps)
+        update_ghosts(guy, ghost_frames)
         draw_player(guy, player_frames)
         
 
-        screen.blit(back_button, button_rect) 
-        myClock.tick(60)
-        display.flip()
+        draw_image(seed_text, (WIDTH - seed_text.get_width() - 10, 10))
+        draw_image(back_button, button_rect)
+        draw_overlay(myClock)
+
+        if bot is not None:
+            bot_tick(bot, perf_counter() - frame_start, chunk_number)
+            if bot["minutes"] and perf_counter() - bot["start"] > bot["minutes"] * 60: # the bot's soak run is over
+                end_run(current_terrain, player_coins, player_gems, chunk_store, bot)
+                running["game"] = False
+
+        if bot is not None and bot["headless"]:
+            myClock.tick() # no frame limit, to see how many ticks per second the game can do
+        else:
+            myClock.tick(60)
+        update_quality(myClock.get_rawtime())
+        present()
+
+
+def end_run(current_terrain, player_coins, player_gems, chunk_store, bot):
+    """
+    Everything that needs to happen when a run ends (quitting or going back to the menu).
+    Bots don't save their coins and gems (or their runs), so soak tests don't change the player's progress.
+    """
+    if bot is None:
+        save_data("player_coins", player_coins) # save player progress
+        save_data(f"player_gems_{current_terrain}", player_gems)
+        record_run(current_terrain, run_record["character"], run_record["seed"], perf_counter() - run_record["start"],
+                   player_coins[0] - run_record["coins"], player_gems[0] - run_record["gems"],
+                   run_record["spike_hits"], run_record["chunks"], player_gems[0])
+    else:
+        finish_bot(bot)
+    stop_ghosts()
+    close_chunk_store(chunk_store)
+    finish_level_ahead()
+    save_generation_timings()
 
 
              
 #--------------------------------------------
 
-def draw_level(guy, level, terrain_blocks, gem_image, player_frames, decor_images, player_coins, player_gems):
+def update_camera(guy):
+    """
+    The camera follows the player on both axes.
+    Horizontally the player is always in the middle of the screen (see draw_level()),
+    vertically the camera keeps the player in the middle unless that would show past the top or bottom of the level.
+    guy[SCROLL_Y] is the y coordinate of the top of the screen in the level.
+    """
+    guy[SCROLL_Y] = guy[Y] + guy[SIZE]//2 - HEIGHT//2
+    if guy[SCROLL_Y] < 0:
+        guy[SCROLL_Y] = 0
+    elif guy[SCROLL_Y] > LEVEL_HEIGHT * TILE_SIZE - HEIGHT:
+        guy[SCROLL_Y] = LEVEL_HEIGHT * TILE_SIZE - HEIGHT
+
+
+def visible_tiles(guy):
+    """
+    Returns the range of rows and columns of the level that are on screen.
+    Only these get drawn, so drawing costs the same no matter how wide or tall the level is.
+    """
+    first_col = max(0, (guy[X] - WIDTH//2) // TILE_SIZE)
+    last_col = min(LEVEL_WIDTH, (guy[X] + WIDTH//2) // TILE_SIZE + 1)
+    first_row = max(0, guy[SCROLL_Y] // TILE_SIZE)
+    last_row = min(LEVEL_HEIGHT, (guy[SCROLL_Y] + HEIGHT) // TILE_SIZE + 1)
+    return range(first_row, last_row), range(first_col, last_col)
+
+
+def draw_level(guy, level, tile_atlas, gem_image, player_coins, player_gems):
     """
-    Takes the 2D list and draws tiles corresponding to the data the list holds.
+    Takes the 2D list and draws the tiles that are on screen corresponding to the data the list holds.
+    The tiles are cut out of the terrain's atlas (see load_tile_atlas()) and all drawn at once.
     """
 
     offset = WIDTH//2 - guy[X] 
-    
-    for row_index, row in enumerate(level): # The level is filled with string values at each position.
-        for col_index, tile_id in enumerate(row): # The string values will finally be blitted as images:
+    offset_y = -guy[SCROLL_Y]
+
+    skipped_tiles = QUALITY_SKIPPED_TILES[quality["tier"]] # on slow computers, decor isn't drawn
+
+    atlas_image = tile_atlas["image"]
+    areas = animated_areas(tile_atlas) # the same for every tile this frame, so animating costs nothing per tile
+
+    blits = [] # (image, position, area) of every tile to draw
+    rows, cols = visible_tiles(guy)
+    for row_index in rows: # The level is filled with string values at each position.
+        row = level[row_index]
+        for col_index in cols: # The string values will finally be blitted as images:
+            tile_id = row[col_index]
             
-            if tile_id:
-                if tile_id in terrain_terms:
-                    tile = terrain_blocks[tile_id] # the tile will be the image (block) at the key of that tile id
-                elif tile_id in dirt_terms:
-                    tile = dirt_blocks[tile_id]
-                else:
-                    tile_images = {"coin":coin_image, # tile_id:corresponding image
-                                   "gem":gem_image,
-                                   "spike":spike_image,
-                                   "safe_spike":spike_image,
-                                   "decor_00":decor_images[0],
-                                   "decor_01":decor_images[1],
-                                   "decor_02":decor_images[2],
-                                   }
-                    
-                    tile = tile_images[tile_id]
-                    
-                if tile:
-                    screen.blit(tile, ((col_index * TILE_SIZE) + offset, row_index * TILE_SIZE))
+            if tile_id and tile_id not in skipped_tiles:
+                blits.append((atlas_image, ((col_index * TILE_SIZE) + offset, row_index * TILE_SIZE + offset_y), areas[tile_id]))
+
+    draw_images(blits)
+    draw_hud(gem_image, player_coins, player_gems)
+
+
+hud = {"coins": None, "gems": None, # the counts the text images below were made for
+       "coins_text": None, "gems_text": None,
+       "coin_icon": None, "gem_icon": None, "gem_source": None}
+
+def draw_hud(gem_image, player_coins, player_gems):
+    """
+    Displays the count of coins and gems the player has collected.
+    The text is only rendered again when a count changes.
+    """
+    if hud["coin_icon"] is None:
+        hud["coin_icon"] = transform.scale(coin_image, (BACKGROUND_SIZE, BACKGROUND_SIZE))
+    if hud["gem_source"] is not gem_image: # a different terrain has a different gem
+        hud["gem_icon"] = transform.scale(gem_image, (BACKGROUND_SIZE, BACKGROUND_SIZE))
+        hud["gem_source"] = gem_image
+
+    if hud["coins_text"] is None or hud["coins"] != player_coins[0]:
+        hud["coins"] = player_coins[0]
+        hud["coins_text"] = pixel_font24.render(str(player_coins[0]), True, (255, 255, 255))
+    if hud["gems_text"] is None or hud["gems"] != player_gems[0]:
+        hud["gems"] = player_gems[0]
+        hud["gems_text"] = pixel_font24.render(str(player_gems[0]), True, (255, 255, 255))
 
     # display the count of coins the player has collected
-    player_coins_text = pixel_font24.render(str(player_coins[0]), True, (255, 255, 255)) 
-    coin_start = WIDTH-coin_image.get_width()-player_coins_text.get_width()-BACKGROUND_SIZE
-    
-    screen.blit(transform.scale(coin_image, (BACKGROUND_SIZE, BACKGROUND_SIZE)), (coin_start, HEIGHT-24))
-    screen.blit(player_coins_text, (coin_start+BACKGROUND_SIZE, HEIGHT-24))
+    coin_start = WIDTH-coin_image.get_width()-hud["coins_text"].get_width()-BACKGROUND_SIZE
+    draw_image(hud["coin_icon"], (coin_start, HEIGHT-24))
+    draw_image(hud["coins_text"], (coin_start+BACKGROUND_SIZE, HEIGHT-24))
     
     # Display gem count
-    player_gems_image = pixel_font24.render(str(player_gems[0]), True, (255, 255, 255))
+    draw_image(hud["gem_icon"], (coin_start, HEIGHT-24*2))
+    draw_image(hud["gems_text"], (coin_start+BACKGROUND_SIZE, HEIGHT-24*2))
+
+
+# The minimap in the top left corner shows the whole chunk, one pixel per tile, and where the player is in it.
+# It's an 8-bit image: every pixel is a tile code (see tile_codes) and its palette turns the codes into colours.
+# So making it for a new chunk is just copying the tile codes into the image (with NumPy if it's installed),
+# and collecting a coin only changes one pixel. Every frame it's one blit for the map and one for the player's marker,
+# no matter how wide the chunk is.
+try: # NumPy is optional, without it the tile codes are copied in with image.frombytes() instead
+    import numpy
+    from pygame import surfarray
+except ImportError:
+    numpy = None
+
+MINIMAP_POSITION = (10, 10)
+MINIMAP_ALPHA = 170 # so the level can still be seen behind it
+
+minimap_colours = {None: (20, 20, 40), # tile id:colour on the minimap
+                   "coin": (255, 210, 40),
+                   "gem": (90, 230, 255),
+                   "spike": (230, 50, 50),
+                   "safe_spike": (120, 60, 60),
+                   "decor_00": (20, 20, 40), "decor_01": (20, 20, 40), "decor_02": (20, 20, 40)}
+for tile_id in terrain_terms:
+    minimap_colours[tile_id] = (110, 200, 80)
+for tile_id in dirt_terms:
+    minimap_colours[tile_id] = (130, 90, 60)
+
+minimap_palette = [(0, 0, 0)] * 256 # tile code:colour
+for code in range(len(tile_codes)):
+    minimap_palette[code] = minimap_colours[tile_codes[code]]
+
+minimap = {"image": None, # the 8-bit image
+           "shown": None, # what gets drawn: a copy in the screen's pixel format, which is a lot faster to blit
+           "marker": Surface((3, 3))} # the player
+minimap["marker"].fill((255, 255, 255))
+
+
+def build_minimap(level):
+    """
+    Makes the minimap of a new chunk.
+    """
+    codes = level_codes(level)
+    if numpy is not None:
+        minimap["image"] = Surface((LEVEL_WIDTH, LEVEL_HEIGHT), depth=8)
+        # surfarray arrays are [x][y], the level is [row][col], so it's flipped (.T)
+        surfarray.blit_array(minimap["image"], numpy.frombuffer(codes, numpy.uint8).reshape(LEVEL_HEIGHT, LEVEL_WIDTH).T)
+    else:
+        minimap["image"] = image.frombytes(bytes(codes), (LEVEL_WIDTH, LEVEL_HEIGHT), "P")
+    minimap["image"].set_palette(minimap_palette)
+
+    if render["mode"] == "texture": # the texture is in the graphics card's format anyway
+        minimap["shown"] = minimap["image"]
+    else:
+        minimap["shown"] = minimap["image"].convert()
+    minimap["shown"].set_alpha(MINIMAP_ALPHA)
+
+
+def minimap_tile_changed(level, row, col):
+    """
+    Updates the one pixel of a tile that changed (a coin that was collected, a spike that was hit).
+    """
+    colour = minimap_colours[level[row][col] or None]
+    minimap["image"].set_at((col, row), colour)
+    minimap["shown"].set_at((col, row), colour)
+    image_changed(minimap["shown"], Rect(col, row, 1, 1))
 
-    screen.blit(transform.scale(gem_image, (BACKGROUND_SIZE, BACKGROUND_SIZE)), (coin_start, HEIGHT-24*2))
-    screen.blit(player_gems_image, (coin_start+BACKGROUND_SIZE, HEIGHT-24*2))
+
+def draw_minimap(guy):
+    if quality["tier"] >= 3: # on slow computers the minimap isn't drawn
+        return
+    draw_image(minimap["shown"], MINIMAP_POSITION)
+    draw_image(minimap["marker"], (MINIMAP_POSITION[X] + guy[X] // TILE_SIZE - 1,
+                                   MINIMAP_POSITION[Y] + (guy[Y] + guy[SIZE]//2) // TILE_SIZE - 1))
 
 #--------------------------------------------
 
-def move_player(guy, moving_right, moving_left, player_frames, player_stats):
+# Collisions are only checked where the player is, so if the player moved more than a tile in one tick
+# (after buying lots of speed or agility, or after falling for a long time) they could skip right over a wall or a platform.
+# So when the player is going to move more than PHYSICS_STEP pixels in a tick, the tick is split into steps:
+# each step moves the player part of the way and checks collisions again, like checking every tile along the way.
+# At normal speeds there's only one step, so that costs nothing extra.
+PHYSICS_STEP = TILE_SIZE - 1 # most pixels the player moves between collision checks
+TERMINAL_VY = TILE_SIZE * 2 # falling never gets faster than this, so a tick is never split into more than 3 steps
+
+
+def physics_steps(guy, player_stats, keys):
+    """
+    Returns how many steps this tick has to be split into.
+    """
+    fastest = abs(guy[VY]) + 1 # falling (gravity adds 1 every tick)
+    if keys[K_UP]:
+        fastest = max(fastest, player_stats[AGILITY])
+    if keys[K_LEFT] or keys[K_RIGHT]:
+        fastest = max(fastest, player_stats[SPEED])
+    return max(1, -(-fastest // PHYSICS_STEP)) # (rounded up)
+
+
+def step_part(amount, step, steps):
+    """
+    The part of amount to move in this step. All the parts add up to amount exactly, so
+    the player ends up in the same place whatever number of steps it took.
+    """
+    return amount * (step + 1) // steps - amount * step // steps
+
+
+def move_player(guy, moving_right, moving_left, player_frames, player_stats, keys, step=0, steps=1):
     """
     Moves the player based on user key presses.
+    keys is what key.get_pressed() returns (or what the bot is pressing, see bot_controls()).
+    When the tick is split into steps (see physics_steps()), this moves the player for one of them.
     """
     
-    keys = key.get_pressed()
     guy[MOVING] = False  # Flag if player is moving to decide wheter to animate or not
+    old_x, old_y = guy[X], guy[Y]
 
     # Horizontal movement
-    if keys[K_LEFT] and guy[X] > guy[START_X] and moving_left: # see moving_left/right in check_collide() function
-        guy[X] -= player_stats[SPEED]
+    if keys[K_LEFT] and (guy[X] > guy[START_X] or chunk_number > 0) and moving_left: # see moving_left/right in check_collide() function
+        # (you can only walk back past the start of a chunk if there's a chunk before it)
+        guy[X] -= step_part(player_stats[SPEED], step, steps)
         guy[DIRECTION] = LEFT # set direction for animation
         guy[MOVING] = True # animation only occurs when there is movement
     
         
     elif keys[K_RIGHT] and guy[X] < LEVEL_WIDTH*TILE_SIZE and moving_right:
-        guy[X] += player_stats[SPEED]
+        guy[X] += step_part(player_stats[SPEED], step, steps)
         guy[DIRECTION] = RIGHT  
         guy[MOVING] = True
         
@@ -758,10 +2362,11 @@ def move_player(guy, moving_right, moving_left, player_frames, player_stats):
 
 
     # Gravity 
-    guy[Y] += guy[VY]
-    guy[VY] += 1  
+    guy[Y] += step_part(guy[VY], step, steps)
+    if step == steps - 1: # gravity only speeds the fall up once per tick
+        guy[VY] = min(guy[VY] + 1, TERMINAL_VY)
 
-    # keep player from jumping/moving out of screen limits.
+    # keep player from jumping/moving out of the level limits.
     if guy[X] < 0:
         guy[X] = 0
     elif guy[X] > LEVEL_WIDTH * TILE_SIZE - guy[SIZE]:
@@ -771,6 +2376,9 @@ def move_player(guy, moving_right, moving_left, player_frames, player_stats):
         guy[Y] = 0
     elif guy[Y] > LEVEL_HEIGHT * TILE_SIZE - guy[SIZE]:
         guy[Y] = LEVEL_HEIGHT * TILE_SIZE - guy[SIZE]
+        guy[VY] = 0 # the bottom of the level stops a fall too
+
+    guy[MOVED_X], guy[MOVED_Y] = abs(guy[X] - old_x), guy[Y] - old_y
 
 
    
@@ -785,13 +2393,19 @@ def draw_player(guy, image_frames): # drawing/blitting and animation
     
     # Blits the player facing the direction they are moving in and the animation frame
     player_image = image_frames[guy[DIRECTION]][int(guy[FRAME])]
-    screen.blit(player_image, (WIDTH//2, guy[Y]))
+    draw_image(player_image, (WIDTH//2, guy[Y] - guy[SCROLL_Y]))
 
     
-def check_collision(guy, level, player_stats, player_coins, player_gems):
-    global game_started
+def check_collision(guy, level, player_stats, player_coins, player_gems, steps=1):
+    global game_started, chunk_step
 
     player_rect = Rect(guy[X], guy[Y], guy[SIZE], guy[SIZE])  # Player rectangle
+
+    # How far the player moved since the last check. That's what the last move_player() really moved them,
+    # which isn't always this tick's step size: the last step could have been from a tick split into fewer steps.
+    # A player standing against a wall didn't move at all, so for walls it's at least the step they're about to take.
+    moved_x = max(guy[MOVED_X], -(-player_stats[SPEED] // steps))
+    moved_y = guy[MOVED_Y]
     
     guy[ONGROUND] = False # These variables are set to these assumptions because in the following code,
     moving_left = True # we will see if they will be proven to be opposite of what they are right here,
@@ -805,10 +2419,20 @@ def check_collision(guy, level, player_stats, player_coins, player_gems):
         # between the start and end of level chunks is smooth)
         
         game_started = False
+        chunk_step = 1
+
+    elif chunk_number > 0 and guy[X] < guy[START_X] - TILE_SIZE:
+        # walking back past the start of the chunk loads the previous chunk from the chunk store.
+        game_started = False
+        chunk_step = -1
         
 
-    for row in range(0, LEVEL_HEIGHT): # Similar to draw_level()
-        for col in range(0, LEVEL_WIDTH):
+    # Only the tiles touching the player can collide with them, so only those are checked.
+    first_row, last_row = max(0, player_rect.top // TILE_SIZE), min(LEVEL_HEIGHT, player_rect.bottom // TILE_SIZE + 1)
+    first_col, last_col = max(0, player_rect.left // TILE_SIZE), min(LEVEL_WIDTH, player_rect.right // TILE_SIZE + 1)
+
+    for row in range(first_row, last_row): # Similar to draw_level()
+        for col in range(first_col, last_col):
             
             tile_id = level[row][col] # string value in 2D list at the current position
             tile_rect = Rect(col * TILE_SIZE, row * TILE_SIZE, TILE_SIZE, TILE_SIZE)
@@ -817,7 +2441,9 @@ def check_collision(guy, level, player_stats, player_coins, player_gems):
 
                 # landing on platform collisions
                 if tile_id in terrain_terms:
-                    if guy[VY] > 0 and player_rect.move(0,-guy[VY]).colliderect(tile_rect)==False:
+                    if guy[VY] > 0 and player_rect.move(0,-moved_y).colliderect(tile_rect)==False:
+                        if guy[VY] >= LANDING_SPEED and not guy[ONGROUND]: # (only once, even if it lands on two tiles)
+                            telemetry_event(LANDING, guy[X], tile_rect.top - guy[SIZE], guy[VY])
                         guy[ONGROUND] = True
                         guy[VY] = 0
                         guy[Y] = tile_rect.top - guy[SIZE]
@@ -825,12 +2451,12 @@ def check_collision(guy, level, player_stats, player_coins, player_gems):
                     
                 # Left/right wall collisoins
                 if tile_id in terrain_terms or tile_id in dirt_terms: # you can also collide with 
-                    if  tile_rect.left <= player_rect.right and player_rect.right < tile_rect.right and  player_rect.move(-player_stats[SPEED], 0).colliderect(tile_rect) == False:
+                    if  tile_rect.left <= player_rect.right and player_rect.right < tile_rect.right and  player_rect.move(-moved_x, 0).colliderect(tile_rect) == False:
                         # set moving_left/right false when a collision occurs,
                         # so then in move_player, the player won't move at all since moving_left/right is false
                         moving_right = False
                         
-                    if  player_rect.left <= tile_rect.right and tile_rect.left < player_rect.left and  player_rect.move(player_stats[SPEED], 0).colliderect(tile_rect) == False:
+                    if  player_rect.left <= tile_rect.right and tile_rect.left < player_rect.left and  player_rect.move(moved_x, 0).colliderect(tile_rect) == False:
                         moving_left = False
 
 
@@ -839,11 +2465,16 @@ def check_collision(guy, level, player_stats, player_coins, player_gems):
                     player_coins[0] += 1
                     coin_sound.play()
                     level[row][col] = None
+                    minimap_tile_changed(level, row, col)
+                    telemetry_event(PICKUP, col, row, 0)
                 if tile_id == "gem":# collect gems
                     player_gems[0] += 1
                     gem_sound.play()
                     level[row][col] = None
+                    minimap_tile_changed(level, row, col)
+                    telemetry_event(PICKUP, col, row, 1)
                 if tile_id == "spike": # get harmed by spikes
+                    telemetry_event(SPIKE_HIT, col, row, min(player_gems[0], player_stats[GEM_RESIST]))
                     player_gems[0] -= player_stats[GEM_RESIST] # gem resist is the number of gems you lose if you touch a spike.
                     if player_gems[0] < 0: # you can upgrade in the shop to reduce this number.
                         player_gems[0] = 0
@@ -853,12 +2484,593 @@ def check_collision(guy, level, player_stats, player_coins, player_gems):
                         player_coins[0] = 0
 
                     level[row][col] = "safe_spike" # once the spike has done damage once, it'll become "safe" and won't continue to hurt the player
+                    minimap_tile_changed(level, row, col)
+                    run_record["spike_hits"] += 1
 
                     
     return moving_right, moving_left
 
+
+def check_landings(player_stats):
+    """
+    Regression check for the physics steps (run with --check-landings): drops the player from every height
+    above the floor and above a floating platform, and checks they always end up standing on it
+    instead of falling into it. Returns the (surface row, start y) pairs that failed.
+    """
+    platform_row = LEVEL_HEIGHT // 2
+    col = guy[START_X] // TILE_SIZE
+    failed = []
+    for surface_row, columns in [(LEVEL_HEIGHT - 1, range(LEVEL_WIDTH)), (platform_row, range(col - 1, col + 3))]:
+        level = []
+        for row in range(LEVEL_HEIGHT):
+            level.append([None] * LEVEL_WIDTH)
+        for c in columns:
+            level[surface_row][c] = "t"
+        standing_y = surface_row * TILE_SIZE - guy[SIZE]
+
+        for start_y in range(standing_y + 1):
+            dropped = guy[:]
+            dropped[X], dropped[Y], dropped[VY], dropped[MOVED_X], dropped[MOVED_Y] = col * TILE_SIZE, start_y, 0, 0, 0
+            keys = {K_LEFT: False, K_RIGHT: False, K_UP: False}
+            for tick in range(120): # long enough to fall the whole level
+                steps = physics_steps(dropped, player_stats, keys)
+                for step in range(steps):
+                    moving_right, moving_left = check_collision(dropped, level, player_stats, [0], [0], steps)
+                    move_player(dropped, moving_right, moving_left, None, player_stats, keys, step, steps)
+            if dropped[Y] - standing_y not in [0, 1]: # standing still "falls" 1 pixel every other tick
+                failed.append((surface_row, start_y))
+    return failed
+
                         
 
+######################################################################
+
+# Bot player
+# For soak tests that run for hours, a bot plays the game instead of a person.
+# It presses the same keys move_player() reads, picking coins and gems it can reach (see find_reachable())
+# and walking towards them, jumping over walls, gaps and spikes on the way.
+# Every REPORT_SECONDS it logs how many ticks per second the game is running at and how long ticks take,
+# and every time it crosses into a new chunk it logs how much memory the game is using.
+# Some chunks can't be finished with the player's stats (a land mass can be taller than the player can jump),
+# so if the bot stays stuck it skips to the next chunk, like a person would give up and start again.
+
+REPORT_SECONDS = 10
+BOT_LOOK_AHEAD = 30 # how many columns ahead the bot looks for coins and gems
+
+
+def start_bot(run_seed):
+    """
+    Makes the dictionary that holds the bot's state and its statistics.
+    """
+    os.makedirs("DATA/logs", exist_ok=True)
+    return {"seed": run_seed,
+            "headless": args.headless,
+            "minutes": args.bot_minutes,
+            "start": perf_counter(),
+            "log": open(f"DATA/logs/bot_{run_seed}_{os.getpid()}.log", "w"), # racing bots all play the same seed
+            "ticks": 0, # ticks since the last report
+            "total_ticks": 0,
+            "tick_times": [], # seconds each tick took since the last report
+            "checkpoints": memory_trace["checkpoints"], # memory checkpoints so far (see bot_tick())
+            "last_report": perf_counter(),
+            "chunk": 0,
+            "level": None, # the level the bot's plan is for
+            "reachable": None,
+            "target": None, # (row, col) of the coin or gem the bot is going for
+            "ignored": set(), # targets the bot gave up on
+            "furthest": 0, # furthest column the bot has got to in this chunk
+            "stuck_ticks": 0, # ticks since the bot last got further or collected something
+            "stuck_times": 0, # how many times in a row the bot got stuck
+            "skipped_chunks": 0}
+
+
+def bot_log(bot, line):
+    bot["log"].write(f"{perf_counter() - bot['start']:10.1f}s  {line}\n")
+    bot["log"].flush()
+    if bot["headless"]:
+        print(f"[bot {bot['seed']}] {line}")
+
+
+def process_memory():
+    """
+    Returns how many megabytes of memory the game is using right now.
+    Linux has this in /proc, everywhere else only the most it has ever used is available.
+    """
+    try:
+        pages = int(open("/proc/self/statm").read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def bot_tick(bot, tick_seconds, chunk_number):
+    """
+    Records how long a tick took, and logs reports.
+    """
+    bot["ticks"] += 1
+    bot["total_ticks"] += 1
+    if memory_trace["checkpoints"] == bot["checkpoints"]:
+        bot["tick_times"].append(tick_seconds)
+    else: # a tick with a memory checkpoint in it (see --memory-trace) isn't a normal tick, so it's left out of the tick times
+        bot["checkpoints"] = memory_trace["checkpoints"]
+
+    if chunk_number != bot["chunk"]:
+        bot_log(bot, f"chunk {bot['chunk']} -> {chunk_number}  memory {process_memory():.1f} MB")
+        bot["chunk"] = chunk_number
+
+    now = perf_counter()
+    if now - bot["last_report"] >= REPORT_SECONDS:
+        times = sorted(bot["tick_times"])
+        bot_log(bot, f"{bot['ticks'] / (now - bot['last_report']):.0f} ticks/s  "
+                     f"tick ms p50 {percentile(times, 0.5)*1000:.2f} p95 {percentile(times, 0.95)*1000:.2f} "
+                     f"p99 {percentile(times, 0.99)*1000:.2f} max {times[-1]*1000:.2f}  "
+                     f"memory {process_memory():.1f} MB  quality {quality['tier']}")
+        bot["ticks"] = 0
+        bot["tick_times"] = []
+        bot["last_report"] = now
+
+
+def finish_bot(bot):
+    bot_log(bot, f"done after {bot['total_ticks']} ticks, {perf_counter() - bot['start']:.0f}s, skipped {bot['skipped_chunks']} chunks")
+    bot["log"].close()
+
+
+def bot_controls(bot, guy, level, reachable, player_stats):
+    """
+    Decides which keys the bot presses this tick. Returns a dictionary that move_player() can use like key.get_pressed().
+    reachable is what generating the level found a player with LEVEL_STATS can reach, or None if the level came from the chunk store.
+    """
+    global game_started, chunk_step
+
+    if bot["level"] is not level: # new chunk, so the old plan doesn't apply
+        bot["level"] = level
+        bot["reachable"] = reachable
+        if reachable is None or (player_stats[SPEED], player_stats[AGILITY]) != (LEVEL_STATS[SPEED], LEVEL_STATS[AGILITY]):
+            bot["reachable"] = find_reachable(level, player_stats)
+        bot["target"] = None
+        bot["ignored"] = set()
+        bot["furthest"] = 0
+        bot["stuck_ticks"] = 0
+
+    col = (guy[X] + guy[SIZE]//2) // TILE_SIZE
+    feet_row = (guy[Y] + guy[SIZE]) // TILE_SIZE
+
+    # Pick the closest reachable coin or gem ahead of the bot. Gems are worth more, so they count as closer.
+    if bot["target"] is None or level[bot["target"][0]][bot["target"][1]] not in REACH_COLLECTIBLES:
+        if bot["target"] is not None: # collected it
+            bot["stuck_ticks"] = 0
+            bot["stuck_times"] = 0
+        bot["target"] = None
+        best = None
+        for c in range(max(0, col - 2), min(LEVEL_WIDTH, col + BOT_LOOK_AHEAD)):
+            for r in range(LEVEL_HEIGHT):
+                if level[r][c] in REACH_COLLECTIBLES and bot["reachable"][r][c] and (r, c) not in bot["ignored"]:
+                    distance = abs(c - col) + abs(r - feet_row) / 2
+                    if level[r][c] == "gem":
+                        distance -= 5
+                    if best is None or distance < best:
+                        best = distance
+                        bot["target"] = (r, c)
+
+    if bot["target"] is not None:
+        target_row, target_col = bot["target"]
+    else: # nothing to collect nearby, so head for the end of the chunk
+        target_row, target_col = feet_row, LEVEL_WIDTH - 1
+
+    keys = {K_LEFT: False, K_RIGHT: False, K_UP: False}
+    direction = 1
+    if target_col < col:
+        keys[K_LEFT] = True
+        direction = -1
+    elif target_col > col:
+        keys[K_RIGHT] = True
+
+    if direction > 0: # the column just past the side of the player the bot is walking towards
+        ahead = (guy[X] + guy[SIZE]) // TILE_SIZE
+    else:
+        ahead = (guy[X] - 1) // TILE_SIZE
+    if 0 <= ahead < LEVEL_WIDTH and guy[ONGROUND]:
+        body_rows = range(max(0, guy[Y] // TILE_SIZE), min(LEVEL_HEIGHT, feet_row))
+        wall = any(level[r][ahead] in solid_terms for r in body_rows)
+        gap = feet_row < LEVEL_HEIGHT and level[feet_row][ahead] not in solid_terms
+        spike = any(0 <= c < LEVEL_WIDTH and level[feet_row-1][c] == "spike" for c in [ahead, ahead + direction])
+        target_above = target_row < feet_row - 1 and abs(target_col - col) <= 3
+        if wall or gap or spike or target_above:
+            keys[K_UP] = True
+
+    # If the bot hasn't got anywhere for a while, give up on the target and try jumping out.
+    if col > bot["furthest"]:
+        bot["furthest"] = col
+        bot["stuck_ticks"] = 0
+        bot["stuck_times"] = 0
+    else:
+        bot["stuck_ticks"] += 1
+        if bot["stuck_ticks"] > 120:
+            if bot["target"] is not None:
+                bot["ignored"].add(bot["target"])
+                bot["target"] = None
+            keys[K_UP] = True
+            if bot["stuck_ticks"] > 240: # still stuck, walk back a bit
+                keys[K_LEFT], keys[K_RIGHT] = keys[K_RIGHT], keys[K_LEFT]
+            if bot["stuck_ticks"] > 360:
+                bot["stuck_ticks"] = 0
+                bot["stuck_times"] += 1
+                if bot["stuck_times"] >= 3:
+                    bot_log(bot, f"stuck at column {bot['furthest']}, skipping to the next chunk")
+                    bot["stuck_times"] = 0
+                    bot["skipped_chunks"] += 1
+                    game_started = False
+                    chunk_step = 1
+                    guy[Y] = (LEVEL_HEIGHT - 2) * TILE_SIZE - guy[SIZE] # start the next chunk standing on its floor,
+                    guy[VY] = 0 # not wherever the bot got stuck (which could be inside a wall)
+
+    if keys[K_LEFT] and guy[X] <= guy[START_X]: # the bot never goes back into the chunk before
+        keys[K_LEFT] = False
+
+    return keys
+
+
+def run_bot():
+    """
+    Starts a run with the bot playing, skipping the menus.
+    """
+    global game_started, RUN_SEED
+    race_seed = ghost_seed()
+    if race_seed is not None: # racing ghosts plays their seed (see run_game()), so the bot's log has to be named after it
+        RUN_SEED = race_seed
+    if RUN_SEED is None:
+        RUN_SEED = Random().getrandbits(32)
+    game_started = False
+    run_game(generate_player(args.character), args.terrain, start_bot(RUN_SEED))
+
+
+def run_bot_processes():
+    """
+    Runs --bot-processes copies of the game at once, each with its own bot and seed, and waits for all of them.
+    Each copy gets its number with --bot-number, so it writes its own memory report and telemetry (see LOG_SUFFIX).
+    """
+    first_seed = RUN_SEED if RUN_SEED is not None else Random().getrandbits(32)
+    command = [sys.executable, os.path.abspath(__file__), "--bot",
+               "--bot-minutes", str(args.bot_minutes), "--terrain", args.terrain, "--character", str(args.character)]
+    if args.headless:
+        command.append("--headless")
+    command += ["--renderer", args.renderer]
+    if args.ghosts: # the bots race each other
+        command += ["--ghosts", "--ghost-port", str(args.ghost_port)]
+    if args.memory_trace:
+        command += ["--memory-trace", "--memory-frames", str(args.memory_frames)]
+    if args.telemetry:
+        command.append("--telemetry")
+
+    bots = []
+    for b in range(args.bot_processes):
+        bots.append(subprocess.Popen(command + ["--seed", str(first_seed + b), "--bot-number", str(b)]))
+    for b in bots:
+        b.wait()
+
+
+######################################################################
+
+# Ghost race
+# Several copies of the game on the same computer can race each other: every player sees the others as see-through "ghosts".
+# One copy runs the ghost server (--ghost-server), and the others connect to it with --ghosts.
+# The server gives every player the same seed, so everyone plays the same chunks.
+# A run can also be recorded to a file (--ghost-record) and raced against later (--ghost-replay).
+#
+# Every frame each player sends where they are (see ghost_state()) to the server. To keep that small,
+# only what changed since the last time is sent, and x, y and the chunk are sent as how much they changed (see encode_ghost()).
+# 60 times a second the server sends everyone one "snapshot" with the changes of every player since the snapshot before,
+# so the work for the server grows with the number of players, not the number of players squared.
+# The networking runs on asyncio in its own thread, so the game never waits for it.
+#
+# Every message starts with its length (2 bytes). Messages from the server start with their type:
+# GHOST_WELCOME: your ghost id, the race's seed
+# GHOST_SNAPSHOT: number of ghosts, then the ghost id and encode_ghost() of each one
+# Messages to the server are just encode_ghost() of the player.
+
+GHOST_TICK = 1 / 60 # seconds between snapshots
+GHOST_ALPHA = 110 # how see-through ghosts are (0-255)
+GHOST_WELCOME, GHOST_SNAPSHOT = 1, 2
+
+ghost_length = struct.Struct("<H")
+ghost_welcome = struct.Struct("<BHI") # GHOST_WELCOME, ghost id, seed
+ghost_snapshot = struct.Struct("<BH") # GHOST_SNAPSHOT, number of ghosts
+ghost_id = struct.Struct("<H")
+ghost_full = struct.Struct("<iiiBB") # x, y, chunk number, direction, animation frame
+ghost_delta = struct.Struct("<h") # change of x, y or chunk number
+ghost_recording = struct.Struct("<4sHI") # "TQGR", version, seed (at the start of a recording)
+GHOST_RECORDING_VERSION = 1
+
+# The first byte of an encoded ghost says what follows. Bits 0-4 are which of the 5 values changed,
+GHOST_FULL = 0x80 # or all 5 values follow as they are (ghost_full),
+GHOST_GONE = 0x40 # or the player stopped playing.
+
+ghost_net = {"loop": None, # the asyncio loop of the networking thread
+             "writer": None, # the connection to the server
+             "ready": threading.Event(), # set when the server's welcome arrives (or connecting failed)
+             "id": None, "seed": None, # from the welcome
+             "ghosts": {}, # ghost id:(x, y, chunk, direction, frame) of everyone, replaced as a whole by each snapshot
+             "sent": None, # what was sent last, encode_ghost() sends what changed since then
+             "record_file": None,
+             "recorded": None, # what was recorded last
+             "replay": None, # the recording being raced against
+             "replay_at": 0, # where in it the next frame is
+             "replay_state": None}
+
+
+def ghost_state(guy):
+    return (guy[X], guy[Y], chunk_number, guy[DIRECTION], int(guy[FRAME]))
+
+
+def encode_ghost(previous, state):
+    """
+    Returns the bytes that turn previous into state (None means the player is gone).
+    previous is None when the other side doesn't know anything yet.
+    """
+    if state is None:
+        return bytes([GHOST_GONE])
+    if previous is None:
+        return bytes([GHOST_FULL]) + ghost_full.pack(*state)
+
+    changed = 0
+    parts = []
+    for i in range(3): # x, y and chunk as changes
+        change = state[i] - previous[i]
+        if change:
+            if not -32768 <= change <= 32767: # too big to fit, send everything instead
+                return bytes([GHOST_FULL]) + ghost_full.pack(*state)
+            changed |= 1 << i
+            parts.append(ghost_delta.pack(change))
+    for i in range(3, 5): # direction and animation frame as they are
+        if state[i] != previous[i]:
+            changed |= 1 << i
+            parts.append(bytes([state[i]]))
+    return bytes([changed]) + b"".join(parts)
+
+
+def decode_ghost(previous, data, offset):
+    """
+    Reads what encode_ghost() made from data at offset.
+    Returns the new state (None if the player is gone) and the offset after it.
+    """
+    changed = data[offset]
+    offset += 1
+    if changed & GHOST_GONE:
+        return None, offset
+    if changed & GHOST_FULL:
+        return ghost_full.unpack_from(data, offset), offset + ghost_full.size
+
+    state = list(previous)
+    for i in range(3):
+        if changed & (1 << i):
+            state[i] += ghost_delta.unpack_from(data, offset)[0]
+            offset += ghost_delta.size
+    for i in range(3, 5):
+        if changed & (1 << i):
+            state[i] = data[offset]
+            offset += 1
+    return tuple(state), offset
+
+
+def ghost_message(payload):
+    return ghost_length.pack(len(payload)) + payload
+
+
+async def read_ghost_message(reader):
+    length = ghost_length.unpack(await reader.readexactly(ghost_length.size))[0]
+    return await reader.readexactly(length)
+
+
+#--------------------------------------------
+
+def run_ghost_server():
+    """
+    The ghost server (--ghost-server). Passes every player's position on to everyone else until it's stopped.
+    It doesn't run the game, so it can be left running in a terminal while the players come and go.
+    """
+    seed = RUN_SEED if RUN_SEED is not None else Random().getrandbits(32)
+    print(f"ghost server on port {args.ghost_port}, seed {seed}")
+    try:
+        asyncio.run(serve_ghosts(seed))
+    except OSError as error: # most likely another ghost server is already using the port
+        print(f"couldn't start the ghost server: {error}")
+    except KeyboardInterrupt:
+        pass
+
+
+async def serve_ghosts(seed):
+    server = {"states": {}, # ghost id:the latest state from that player
+              "sent": {}, # ghost id:the state in the last snapshot
+              "writers": {}, # ghost id:connection, for everyone that already has the last snapshot
+              "joined": {}, # ghost id:connection, for players that still need everyone's full state
+              "next_id": 0}
+
+    async def player_connected(reader, writer):
+        ghost = server["next_id"]
+        server["next_id"] += 1
+        writer.write(ghost_message(ghost_welcome.pack(GHOST_WELCOME, ghost, seed)))
+        server["joined"][ghost] = writer
+        state = None
+        try:
+            while True:
+                state = decode_ghost(state, await read_ghost_message(reader), 0)[0]
+                server["states"][ghost] = state
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        server["states"][ghost] = None # gone, the next snapshot tells everyone
+        server["writers"].pop(ghost, None)
+        server["joined"].pop(ghost, None)
+        writer.close()
+
+    listener = await asyncio.start_server(player_connected, "127.0.0.1", args.ghost_port)
+    async with listener:
+        while True:
+            await asyncio.sleep(GHOST_TICK)
+
+            # players that just joined get the full state of everyone in the last snapshot first
+            if server["joined"]:
+                everyone = [ghost_id.pack(g) + encode_ghost(None, s) for g, s in server["sent"].items()]
+                full = ghost_message(ghost_snapshot.pack(GHOST_SNAPSHOT, len(everyone)) + b"".join(everyone))
+                for ghost, writer in server["joined"].items():
+                    writer.write(full)
+                    server["writers"][ghost] = writer
+                server["joined"].clear()
+
+            # then everyone gets what changed since the last snapshot
+            changes = []
+            for ghost, state in list(server["states"].items()):
+                if state != server["sent"].get(ghost):
+                    changes.append(ghost_id.pack(ghost) + encode_ghost(server["sent"].get(ghost), state))
+                    server["sent"][ghost] = state
+                if state is None:
+                    del server["states"][ghost]
+                    server["sent"].pop(ghost, None)
+            if changes:
+                snapshot = ghost_message(ghost_snapshot.pack(GHOST_SNAPSHOT, len(changes)) + b"".join(changes))
+                for writer in server["writers"].values():
+                    writer.write(snapshot)
+
+
+#--------------------------------------------
+
+def start_ghost_client():
+    """
+    Connects to the ghost server (--ghosts) in a new thread, and waits for the welcome so the race's seed is known.
+    Does nothing if it's already connected.
+    """
+    if ghost_net["loop"] is not None:
+        return
+    ghost_net["loop"] = asyncio.new_event_loop()
+    threading.Thread(target=ghost_net["loop"].run_until_complete, args=(ghost_client(),), daemon=True).start()
+    if not ghost_net["ready"].wait(2) or ghost_net["id"] is None:
+        print(f"couldn't connect to a ghost server on port {args.ghost_port}, playing without ghosts")
+
+
+async def ghost_client():
+    try:
+        reader, ghost_net["writer"] = await asyncio.open_connection("127.0.0.1", args.ghost_port)
+        welcome = await read_ghost_message(reader)
+        kind, ghost_net["id"], ghost_net["seed"] = ghost_welcome.unpack(welcome)
+    except (OSError, asyncio.IncompleteReadError):
+        ghost_net["writer"] = None
+        return
+    finally:
+        ghost_net["ready"].set()
+
+    try:
+        while True:
+            snapshot = await read_ghost_message(reader)
+            kind, count = ghost_snapshot.unpack_from(snapshot)
+            ghosts = dict(ghost_net["ghosts"]) # a new dictionary, so the game's thread never sees one half updated
+            offset = ghost_snapshot.size
+            for c in range(count):
+                ghost = ghost_id.unpack_from(snapshot, offset)[0]
+                ghosts[ghost], offset = decode_ghost(ghosts.get(ghost), snapshot, offset + ghost_id.size)
+                if ghosts[ghost] is None:
+                    del ghosts[ghost]
+            ghost_net["ghosts"] = ghosts
+    except (asyncio.IncompleteReadError, ConnectionError):
+        ghost_net["writer"] = None
+        ghost_net["ghosts"] = {}
+
+
+def send_ghost(state):
+    """
+    Sends the player's state to the server (only what changed). state is None when the run ends.
+    """
+    if ghost_net["writer"] is None or state == ghost_net["sent"]:
+        return
+    message = ghost_message(encode_ghost(ghost_net["sent"], state))
+    ghost_net["sent"] = state
+    ghost_net["loop"].call_soon_threadsafe(ghost_net["writer"].write, message)
+
+
+#--------------------------------------------
+
+def ghost_seed():
+    """
+    Returns the seed the run has to use to race the ghosts (the server's, or the recording's), or None.
+    """
+    if args.ghosts:
+        start_ghost_client()
+        if ghost_net["seed"] is not None:
+            return ghost_net["seed"]
+    if args.ghost_replay:
+        return ghost_recording.unpack_from(open(args.ghost_replay, "rb").read(ghost_recording.size))[2]
+    return None
+
+
+def start_ghosts(run_seed, player_frames):
+    """
+    Gets the ghosts ready at the start of a run. Returns the see-through copies of the player's frames the ghosts are drawn with.
+    """
+    ghost_net["sent"] = None
+    if args.ghost_record:
+        ghost_net["record_file"] = open(args.ghost_record, "wb")
+        ghost_net["record_file"].write(ghost_recording.pack(b"TQGR", GHOST_RECORDING_VERSION, run_seed))
+    if args.ghost_replay:
+        ghost_net["replay"] = open(args.ghost_replay, "rb").read()
+        ghost_net["replay_at"] = ghost_recording.size
+        ghost_net["replay_state"] = None
+
+    ghost_frames = []
+    for direction in player_frames:
+        ghost_frames.append([])
+        for frame in direction:
+            ghost_frame = frame.copy()
+            ghost_frame.set_alpha(GHOST_ALPHA)
+            ghost_frames[-1].append(ghost_frame)
+    return ghost_frames
+
+
+def update_ghosts(guy, ghost_frames):
+    """
+    Called every frame: sends and records where the player is, moves the recorded ghost on by a frame,
+    and draws the ghosts that are in the same chunk as the player.
+    """
+    state = ghost_state(guy)
+    send_ghost(state)
+
+    if ghost_net["record_file"] is not None: # one encode_ghost() per frame, so the recording plays back at the same speed
+        record = encode_ghost(ghost_net["recorded"], state)
+        ghost_net["record_file"].write(bytes([len(record)]) + record)
+        ghost_net["recorded"] = state
+
+    ghosts = list(ghost_net["ghosts"].items())
+    if ghost_net["replay"] is not None and ghost_net["replay_at"] < len(ghost_net["replay"]):
+        length = ghost_net["replay"][ghost_net["replay_at"]]
+        ghost_net["replay_state"] = decode_ghost(ghost_net["replay_state"], ghost_net["replay"], ghost_net["replay_at"] + 1)[0]
+        ghost_net["replay_at"] += 1 + length
+    if ghost_net["replay"] is not None and ghost_net["replay_state"] is not None:
+        ghosts.append(("replay", ghost_net["replay_state"]))
+
+    if quality["tier"] >= 3: # on slow computers the ghosts aren't drawn (but the race still goes on)
+        return
+    offset = WIDTH//2 - guy[X]
+    for ghost, (x, y, chunk, direction, frame) in ghosts:
+        if ghost != ghost_net["id"] and chunk == chunk_number:
+            draw_image(ghost_frames[direction][frame % len(ghost_frames[direction])], (x + offset, y - guy[SCROLL_Y]))
+
+
+def stop_ghosts():
+    """
+    At the end of a run: tells the server the player is gone and finishes the recording.
+    """
+    send_ghost(None)
+    ghost_net["sent"] = None
+    if ghost_net["record_file"] is not None:
+        ghost_net["record_file"].close()
+        ghost_net["record_file"] = None
+        ghost_net["recorded"] = None
+    ghost_net["replay"] = None
+
+
+
 ######################################################################
 
 def run_shop():
@@ -868,6 +3080,7 @@ def run_shop():
     from "100 Days of Code: The Complete Python Pro Bootcamp" on Udemy.
     
     """
+    scene_changed("shop")
     background_image = generate_background("green")
     unlocked_players = extract_data("unlocked_players")
     unlocked_terrains = extract_data("unlocked_terrains")
@@ -928,7 +3141,7 @@ def run_shop():
     
     running["shop"] = True
     while running["shop"]:
-        for e in event.get():
+        for e in get_events():
             if e.type == QUIT:
                 running["shop"] = False
             if e.type == MOUSEBUTTONDOWN:
@@ -1000,7 +3213,7 @@ def run_shop():
         screen.blit(player_coins_text, (coin_start+BACKGROUND_SIZE, HEIGHT-24))
 
         screen.blit(back_button, button_rect)
-        display.flip()
+        present()
 
 
     
@@ -1011,6 +3224,7 @@ def run_tutorial():
     from "100 Days of Code: The Complete Python Pro Bootcamp" on Udemy.
     
     """
+    scene_changed("tutorial")
     background_image = generate_background("green")
 
     scroll_start = image.load(f"DATA/images/tutorial/scroll_start.png") # top part of the parchment scroll
@@ -1031,7 +3245,7 @@ def run_tutorial():
 
     running["tutorial"] = True
     while running["tutorial"]:
-        for e in event.get():
+        for e in get_events():
             if e.type == QUIT:
                 running["tutorial"] = False
                 
@@ -1059,7 +3273,26 @@ def run_tutorial():
             offset += i.get_height()
 
         screen.blit(back_button, button_rect)
-        display.flip()
-
-main_menu() # Start the game!
+        present()
+
+if args.leaderboard:
+    print_leaderboard()
+elif args.ghost_server:
+    run_ghost_server()
+elif args.check_landings:
+    failed = check_landings(extract_data("player_stats"))
+    for surface_row, start_y in failed:
+        print(f"dropped from y {start_y}, the player didn't land on row {surface_row}")
+    print(f"{len(failed)} failed drops")
+    if failed:
+        sys.exit(1)
+elif args.bot_processes > 1:
+    run_bot_processes()
+elif args.bot:
+    run_bot()
+else:
+    main_menu() # Start the game!
+finish_run_history() # don't quit before the last run is saved
+finish_telemetry()
+finish_memory_report()
 quit()